@@ -0,0 +1,299 @@
+"""Measures how the stages of untangling scale with the size of the commit."""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import commit_splitter
+import git_tree
+import merger
+import scoring
+import stubs
+import voters
+from condensed_matrix import CondensedMatrix
+from method_indexer import index_snapshots
+from method_lookup import MethodLookup
+from source_file import SourceFileSnapshot
+from synthetic_repo import SyntheticRepo
+from untangler import Untangler
+
+
+# How each benchmark is expected to grow with the number of changes, as the
+# exponent of a power law. Setting the voters up is quadratic in the number
+# of files or methods at worst, scoring and merging in the number of changes.
+EXPECTED_EXPONENTS = {'collect_changes': 1, 'method_index': 1, 'voter.file.setup': 1}
+
+# Growth this much faster than expected is flagged in the curves.
+EXPONENT_TOLERANCE = 0.5
+
+# Times shorter than this are too noisy to fit an exponent to, in seconds.
+MIN_FIT_TIME = 1e-3
+
+
+def _forget_caches():
+    """
+    Empties the in-memory caches of snapshots and tree indexes, so that
+    every repeat of a benchmark builds them again. Git objects stay
+    cached by the reader of the repository.
+    """
+
+    SourceFileSnapshot.snapshot_cache.clear()
+    git_tree.tree_index_cache.clear()
+
+
+def best_time(function, repeat, setup=None):
+    """
+    :param function: The code to time.
+    :type function: () -> object
+    :param repeat: The number of times to run it.
+    :type repeat: int
+    :param setup: The code to run before each run, untimed.
+    :type setup: (() -> None) | None
+    :returns: The shortest time of a run, in seconds, and the result of the last run.
+    :rtype: (float, object)
+    """
+
+    best = math.inf
+    result = None
+
+    for _ in range(repeat):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def benchmark_commit(untangler, commit_hash, repeat=3, jobs=1, threshold=0.4):
+    """
+    Times the stages of untangling a commit, and each voter on its own.
+    :param untangler: The untangler of the repository.
+    :type untangler: untangler.Untangler
+    :param commit_hash: The hash of the commit.
+    :type commit_hash: str
+    :param repeat: The number of runs of each benchmark, of which the fastest counts.
+    :type repeat: int
+    :param jobs: The number of processes to build the change matrix with.
+    :type jobs: int
+    :param threshold: The threshold to merge the changes at.
+    :type threshold: float
+    :returns: The number of changes of the commit, and the time of each benchmark, by name.
+    :rtype: (int, dict[str, float])
+    """
+
+    commit = untangler.repo.commit(commit_hash)
+    times = {}
+
+    times['collect_changes'], changes = best_time(lambda: commit_splitter.collect_changes(untangler.repo, commit, untangler.repo_path), repeat, _forget_caches)
+    size = len(changes)
+
+    snapshots = [change.source_file_snapshot for change in changes]
+    times['method_index'], method_index = best_time(lambda: index_snapshots(untangler.reader, snapshots), repeat)
+
+    resources = {
+        'tree': commit.tree,
+        'co_change_index': untangler.co_change_index(),
+        'call_graph': stubs.stub_call_graph(untangler.reader, commit.hexsha),
+        'method_lookup': MethodLookup(method_index)
+    }
+
+    for name, voter_class in voters.VOTERS.items():
+        times[f'voter.{name}.setup'], scorer = best_time(lambda: scoring.PairScorer([voter_class], resources, changes), repeat, _forget_caches)
+
+        change_matrix = CondensedMatrix(size)
+        times[f'voter.{name}.votes'], _ = best_time(lambda: scorer.score_rows(change_matrix, 0, size), repeat)
+
+    times['matrix'], change_matrix = best_time(lambda: scoring.score_changes(resources, changes, jobs=jobs), repeat, _forget_caches)
+    times['merge'], _ = best_time(lambda: merger.merge(change_matrix, changes, threshold), repeat)
+
+    return size, times
+
+
+def exponent(results, name):
+    """
+    Fits the growth of a benchmark between the two largest commits.
+    :param results: The results of each commit, from the smallest.
+    :type results: list[dict]
+    :param name: The name of the benchmark.
+    :type name: str
+    :returns: The exponent of the power law through the two points, or
+    None when the times are too short to tell.
+    :rtype: float | None
+    """
+
+    if len(results) < 2:
+        return None
+
+    small, large = results[-2], results[-1]
+    time_small, time_large = small['times'][name], large['times'][name]
+
+    if min(time_small, time_large) < MIN_FIT_TIME or large['changes'] <= small['changes']:
+        return None
+
+    return math.log(time_large / time_small) / math.log(large['changes'] / small['changes'])
+
+
+def print_curves(results, output=sys.stdout):
+    """
+    Prints the time of each benchmark by number of changes, in milliseconds,
+    with its growth exponent. Exponents well above the expected ones are
+    flagged with a !.
+    :param results: The results of each commit, from the smallest.
+    :type results: list[dict]
+    :param output: Where to print the curves.
+    :type output: io.TextIOBase
+    """
+
+    names = list(results[0]['times'])
+    width = max(len(name) for name in names)
+
+    print(f'{"changes":<{width}} ' + ' '.join(f'{r["changes"]:>10}' for r in results) + '   exponent', file=output)
+
+    for name in names:
+        growth = exponent(results, name)
+        expected = EXPECTED_EXPONENTS.get(name, 2)
+
+        if growth is None:
+            fit = '         -'
+        else:
+            fit = f'{growth:>8.2f} {"!" if growth > expected + EXPONENT_TOLERANCE else " "}'
+
+        print(f'{name:<{width}} ' + ' '.join(f'{r["times"][name] * 1000:>10.2f}' for r in results) + f'   {fit} (expected {expected})', file=output)
+
+
+def main(sizes, files=500, depth=4, methods=8, history=1000, repeat=3, jobs=1, seed=1, output=None):
+    """
+    Generates a synthetic repository with a tangled commit of each size,
+    benchmarks untangling them and prints the scaling curves.
+    :param sizes: The number of lines changed by each tangled commit.
+    :type sizes: list[int]
+    :param files: The number of Java files of the repository.
+    :type files: int
+    :param depth: The depth of the package tree.
+    :type depth: int
+    :param methods: The number of methods of each class.
+    :type methods: int
+    :param history: The number of commits before the tangled commits.
+    :type history: int
+    :param repeat: The number of runs of each benchmark, of which the fastest counts.
+    :type repeat: int
+    :param jobs: The number of processes to build the change matrix with.
+    :type jobs: int
+    :param seed: The seed of the repository generator.
+    :type seed: int
+    :param output: A file to write the results to as JSON, if any.
+    :type output: str | None
+    """
+
+    scratch_path = tempfile.mkdtemp(prefix='untangler-benchmarks-')
+
+    try:
+        repo_path = os.path.join(scratch_path, 'repo')
+
+        start = time.perf_counter()
+        commit_hashes = SyntheticRepo(files, depth, methods, history, seed).write(repo_path, sorted(sizes))
+        print(f'Generated the repository in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+        stubs.install()
+        untangler = Untangler(repo_path, cache_dir=os.path.join(scratch_path, 'cache'))
+        results = []
+
+        for size in sorted(sizes):
+            changes, times = benchmark_commit(untangler, commit_hashes[size], repeat, jobs)
+            results.append({'size': size, 'changes': changes, 'pairs': changes * (changes - 1) // 2, 'times': times})
+            print(f'Benchmarked {changes} changes', file=sys.stderr)
+
+        untangler.close()
+        print_curves(results)
+
+        if output:
+            parameters = {'files': files, 'depth': depth, 'methods': methods, 'history': history, 'repeat': repeat, 'jobs': jobs, 'seed': seed}
+
+            with open(output, 'w') as f:
+                json.dump({'parameters': parameters, 'results': results}, f, indent=2)
+                f.write('\n')
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks untangling synthetic tangled commits of growing sizes, without Understand.'
+    )
+
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000, 5000],
+        help='The number of lines changed by each tangled commit. Defaults to 10 100 1000 5000. '
+             'The change matrix takes 2n² bytes, so 50000 lines need about 5 GB.'
+    )
+
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=500,
+        help='The number of Java files of the repository. Defaults to 500.'
+    )
+
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=4,
+        help='The depth of the package tree. Defaults to 4.'
+    )
+
+    parser.add_argument(
+        '--methods',
+        type=int,
+        default=8,
+        help='The number of methods of each class. Defaults to 8.'
+    )
+
+    parser.add_argument(
+        '--history',
+        type=int,
+        default=1000,
+        help='The number of commits before the tangled commits. Defaults to 1000.'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='The number of runs of each benchmark, of which the fastest counts. Defaults to 3.'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='The number of processes to build the change matrix with. Defaults to 1.'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='The seed of the repository generator. Defaults to 1.'
+    )
+
+    parser.add_argument(
+        '--output',
+        help='Write the results to this file as JSON, to compare runs.'
+    )
+
+    args = parser.parse_args()
+
+    main(args.sizes, args.files, args.depth, args.methods, args.history, args.repeat, args.jobs, args.seed, args.output)
@@ -0,0 +1,71 @@
+"""Stands in for Understand, with the call graphs of the synthetic repositories."""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import call_graph
+import method_indexer
+
+
+# The static calls of the synthetic sources, e.g. com.bench.p1.C12.m3(b).
+_CALL = re.compile(r'([\w.]+)\.(m\d+)\(')
+
+
+def stub_call_graph(reader, commit_hash):
+    """
+    Builds the call graph of a synthetic repository from its sources,
+    which only call methods by their qualified names. The methods are
+    found with the method indexer, as the call graph voter looks them up.
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
+    :param commit_hash: The hash of the commit.
+    :type commit_hash: str
+    :rtype: call_graph.CallGraph
+    """
+
+    method_ids = {}
+    method_files = []
+    callers = []
+    callees = []
+
+    def intern(name, file_path=None):
+        method_id = method_ids.setdefault(name, len(method_ids))
+
+        if method_id == len(method_files):
+            method_files.append(file_path)
+        elif file_path:
+            method_files[method_id] = file_path
+
+        return method_id
+
+    for file_path, sha in sorted(reader.tree_entries(commit_hash).items()):
+        if not file_path.endswith('.java'):
+            continue
+
+        source = reader.read(sha)[1].decode('utf-8')
+        lines = source.split('\n')
+
+        for line_range, method in method_indexer.index_source(source).items():
+            start, end = [int(l) for l in line_range.split('-')]
+            caller = intern(method, file_path)
+
+            for line in lines[start - 1:end]:
+                for match in _CALL.finditer(line):
+                    callers.append(caller)
+                    callees.append(intern(f'{match.group(1)}.{match.group(2)}'))
+
+    return call_graph.CallGraph.from_edges(list(method_ids), callers, callees, method_files)
+
+
+def install():
+    """
+    Makes the untangler build the call graphs of commits with stub_call_graph
+    instead of Understand. Call graphs are built whole rather than updated
+    from the call graph of the parent commit.
+    """
+
+    call_graph.generate_call_graph = stub_call_graph
+    call_graph.update_call_graph = lambda parent_call_graph, reader, parent_hash, commit_hash: stub_call_graph(reader, commit_hash)
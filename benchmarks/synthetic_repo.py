@@ -0,0 +1,294 @@
+"""Generates Java repositories with a history and tangled commits of any size."""
+
+import argparse
+import json
+import random
+import subprocess
+
+
+class SyntheticRepo(object):
+    """
+    Builds a repository of Java classes in a package tree, with static
+    methods calling methods of other classes. The history changes a few
+    files of one package per commit, so that files co-change. Tangled
+    commits change lines spread over many files and packages, each on a
+    branch of its own on top of the history.
+
+    Everything is written with a single git fast-import, so that large
+    histories take seconds to generate.
+    """
+
+    def __init__(self, files=500, depth=4, methods=8, history=1000, seed=1):
+        """
+        :param files: The number of Java files.
+        :type files: int
+        :param depth: The depth of the package tree.
+        :type depth: int
+        :param methods: The number of methods of each class.
+        :type methods: int
+        :param history: The number of commits before the tangled commits.
+        :type history: int
+        :param seed: The seed of the random generator, for reproducible repositories.
+        :type seed: int
+        """
+
+        self.methods = methods
+        self.history = history
+        self.random = random.Random(seed)
+
+        # Four subpackages per package, with the files spread over the leaves.
+        packages = ['com.bench']
+
+        for _ in range(depth):
+            packages = [f'{package}.p{i}' for package in packages for i in range(4)]
+
+        self.classes = [(self.random.choice(packages), f'C{i}') for i in range(files)]
+        self.sources = {self._path(package, name): self._source(package, name, methods) for package, name in self.classes}
+        self.paths = sorted(self.sources)
+
+        # The files of each package, to make commits that change related files.
+        self.package_paths = {}
+
+        for package, name in self.classes:
+            self.package_paths.setdefault(package, []).append(self._path(package, name))
+
+        self._edits = 0
+
+    @staticmethod
+    def _path(package, name):
+        return f'src/main/java/{package.replace(".", "/")}/{name}.java'
+
+    def _method(self, index):
+        """
+        :param index: The index of the method in its class.
+        :type index: int
+        :returns: The lines of a method, with a call to a method of another class.
+        :rtype: list[str]
+        """
+
+        package, name = self.random.choice(self.classes)
+        callee = self.random.randrange(self.methods)
+
+        return [
+            f'    public static int m{index}(int a) {{',
+            f'        int b = a + {self.random.randrange(100)};',
+            f'        b = {package}.{name}.m{callee}(b);',
+            f'        return b * {self.random.randrange(10)};',
+            '    }',
+            ''
+        ]
+
+    def _source(self, package, name, methods):
+        lines = [f'package {package};', '', f'public class {name} {{', '']
+
+        for index in range(methods):
+            lines += self._method(index)
+
+        lines.append('}')
+
+        return lines
+
+    def _edit(self, path, edited=None):
+        """
+        Changes the constant of a statement of a file.
+        :param path: The path of the file.
+        :type path: str
+        :param edited: The statements already changed, which are then left
+        alone, as (path, line) pairs. Updated with the changed statement.
+        :type edited: set[(str, int)] | None
+        :returns: The number of changed lines (a deletion and an addition),
+        or 0 when every statement of the file was already changed.
+        :rtype: int
+        """
+
+        lines = self.sources[path]
+        statements = [k for k, line in enumerate(lines) if line.startswith('        int b = ') and (path, k) not in (edited or ())]
+
+        if not statements:
+            return 0
+
+        k = self.random.choice(statements)
+
+        if edited is not None:
+            edited.add((path, k))
+
+        self._edits += 1
+        lines[k] = f'        int b = a + {self._edits};'
+
+        return 2
+
+    def _add_method(self, path):
+        """
+        Adds a method at the end of the class of a file.
+        :param path: The path of the file.
+        :type path: str
+        :returns: The number of changed lines (the added lines).
+        :rtype: int
+        """
+
+        lines = self.sources[path]
+        method = self._method(sum(1 for line in lines if line.startswith('    public static')))
+        lines[-1:-1] = method
+
+        return len(method)
+
+    def _tangled_edits(self, changed_lines):
+        """
+        Changes about the given number of lines, in files of a few packages,
+        with edits of existing methods and new methods.
+        :returns: The changed files.
+        :rtype: set[str]
+        """
+
+        # Roughly 10 changed lines per file, spread over packages of 3 files each.
+        files = max(1, min(len(self.paths), changed_lines // 10))
+        packages = self.random.sample(sorted(self.package_paths), min(len(self.package_paths), max(1, files // 3)))
+        candidates = [path for package in packages for path in self.package_paths[package]]
+
+        changed_files = set()
+        edited = set()
+        changed = 0
+
+        while changed < changed_lines:
+            path = self.random.choice(candidates)
+            changed_files.add(path)
+
+            # Methods are added after the statements, so that they don't move.
+            if self.random.random() < 0.7 or changed_lines - changed < 6:
+                changed += self._edit(path, edited) or self._add_method(path)
+            else:
+                changed += self._add_method(path)
+
+        return changed_files
+
+    def write(self, repo_path, tangled_sizes=()):
+        """
+        Writes the repository, with one branch tangled/<size> per tangled commit.
+        :param repo_path: The directory of the repository, which must not exist yet.
+        :type repo_path: str
+        :param tangled_sizes: The number of lines changed by each tangled commit.
+        :type tangled_sizes: list[int]
+        :returns: The hash of each tangled commit, by size.
+        :rtype: dict[int, str]
+        """
+
+        subprocess.run(['git', 'init', '-q', repo_path], check=True)
+
+        process = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=repo_path, stdin=subprocess.PIPE)
+        mark = 0
+
+        def commit(ref, message, paths, parent=None):
+            nonlocal mark
+            mark += 1
+
+            # Commits are one minute apart, from a fixed date.
+            stream = [f'commit {ref}\nmark :{mark}\ncommitter Bench <bench@example.com> {1500000000 + 60 * mark} +0000\n'.encode('utf-8')]
+            stream.append(_data(message))
+
+            if parent:
+                stream.append(f'from :{parent}\n'.encode('utf-8'))
+
+            for path in sorted(paths):
+                stream.append(f'M 100644 inline {path}\n'.encode('utf-8'))
+                stream.append(_data('\n'.join(self.sources[path]) + '\n'))
+
+            process.stdin.write(b''.join(stream))
+
+            return mark
+
+        head = commit('refs/heads/master', 'Initial commit', self.paths)
+
+        for i in range(self.history):
+            package = self.random.choice(sorted(self.package_paths))
+            paths = self.random.sample(self.package_paths[package], min(len(self.package_paths[package]), self.random.randint(1, 3)))
+
+            for path in paths:
+                self._edit(path)
+
+            head = commit('refs/heads/master', f'Change {i}', paths, head)
+
+        # The tangled commits branch off the end of the history, with its sources.
+        history_sources = {path: list(lines) for path, lines in self.sources.items()}
+
+        for size in tangled_sizes:
+            self.sources = {path: list(lines) for path, lines in history_sources.items()}
+            commit(f'refs/heads/tangled/{size}', f'Tangled commit of {size} lines', self._tangled_edits(size), head)
+
+        self.sources = history_sources
+
+        process.stdin.close()
+
+        if process.wait():
+            raise RuntimeError('git fast-import failed')
+
+        subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=repo_path, check=True)
+
+        return {
+            size: subprocess.run(['git', 'rev-parse', f'refs/heads/tangled/{size}'], cwd=repo_path, check=True, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+            for size in tangled_sizes
+        }
+
+
+def _data(text):
+    content = text.encode('utf-8')
+
+    return b'data %d\n%s\n' % (len(content), content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generates a Java repository with a history and tangled commits, for benchmarks.'
+    )
+
+    parser.add_argument(
+        'repo_path',
+        help='The directory to create the repository in.'
+    )
+
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=500,
+        help='The number of Java files. Defaults to 500.'
+    )
+
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=4,
+        help='The depth of the package tree. Defaults to 4.'
+    )
+
+    parser.add_argument(
+        '--methods',
+        type=int,
+        default=8,
+        help='The number of methods of each class. Defaults to 8.'
+    )
+
+    parser.add_argument(
+        '--history',
+        type=int,
+        default=1000,
+        help='The number of commits before the tangled commits. Defaults to 1000.'
+    )
+
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000],
+        help='The number of lines changed by each tangled commit. Defaults to 10 100 1000.'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='The seed of the random generator. Defaults to 1.'
+    )
+
+    args = parser.parse_args()
+
+    repo = SyntheticRepo(args.files, args.depth, args.methods, args.history, args.seed)
+    print(json.dumps(repo.write(args.repo_path, args.sizes), indent=2))
@@ -0,0 +1,237 @@
+"""Bounded in-memory caches, optionally backed by a cache on disk."""
+
+import json
+import os
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+
+
+# Every named cache, so that their statistics can be reported together.
+_named_caches = weakref.WeakSet()
+
+# The counters of the named caches that were garbage collected, by name.
+_collected_counters = {}
+_collected_lock = threading.Lock()
+
+
+def _collect_counters(name, counters):
+    with _collected_lock:
+        total = _collected_counters.setdefault(name, {})
+
+        for key, value in counters.items():
+            total[key] = total.get(key, 0) + value
+
+
+class LRUCache(object):
+    """
+    A mapping that forgets its least recently used entries past a total
+    size. Entries have a size of 1 by default, so that the size limit
+    is a number of entries. Caches are safe to share between threads.
+
+    Keys should address the content of an entry (e.g. the sha of a blob
+    or tree), so that entries never need to be invalidated.
+
+    With a disk cache, every entry is also written to the disk, and the
+    entries missing from memory are looked up on the disk.
+    """
+
+    def __init__(self, max_size, size=lambda value: 1, name=None, disk=None):
+        """
+        :param max_size: The total size of the entries to keep.
+        :type max_size: int
+        :param size: The function calculating the size of an entry.
+        :type size: (object) -> int
+        :param name: The name of the cache in the statistics, if any, see statistics.
+        :type name: str | None
+        :param disk: The cache to keep every entry in on the disk, if any.
+        :type disk: DiskCache | None
+        """
+
+        self.max_size = max_size
+        self.size = 0
+        self.name = name
+        self.disk = disk
+
+        # The lookups found in memory, found on the disk and missed, and the evicted entries.
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if name:
+            _named_caches.add(self)
+            weakref.finalize(self, _collect_counters, name, self.counters)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        :param key: The key of the entry.
+        :returns: The value of the entry, or None if it isn't cached.
+        """
+
+        with self._lock:
+            value = self._entries.get(key)
+
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return value
+
+        value = self.disk.get(key) if self.disk is not None else None
+
+        with self._lock:
+            if value is None:
+                self.counters['misses'] += 1
+                return None
+
+            self.counters['disk_hits'] += 1
+
+        self._remember(key, value)
+
+        return value
+
+    def put(self, key, value):
+        """
+        Caches an entry. Entries larger than the cache are only written to the disk.
+        :param key: The key of the entry.
+        :param value: The value of the entry. None can't be cached.
+        """
+
+        self._remember(key, value)
+
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def _remember(self, key, value):
+        """
+        Keeps an entry in memory, unless it is larger than the cache itself.
+        """
+
+        size = self._size(value)
+
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._size(self._entries.pop(key))
+
+            self._entries[key] = value
+            self.size += size
+
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self._size(evicted)
+                self.counters['evictions'] += 1
+
+    def clear(self):
+        """
+        Forgets the entries kept in memory.
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :returns: The number of lookups found in memory, found on the disk and
+        missed, the number of evicted entries, and the entries kept in memory.
+        :rtype: dict[str, int]
+        """
+
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), size=self.size)
+
+
+class DiskCache(object):
+    """
+    A persistent mapping of strings to JSON values, in an SQLite database.
+    The database can be shared by threads and processes, each using their
+    own connection. Entries are never evicted, so keys should address
+    contents that are worth keeping (e.g. the sha of a blob).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The database file, created if it doesn't exist.
+        :type path: str
+        """
+
+        self.path = path
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _connection(self):
+        """
+        :returns: The connection of the thread, opened the first time it is needed.
+        Connections aren't shared with forked processes.
+        :rtype: sqlite3.Connection
+        """
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=60)
+
+            # Readers don't wait for writers, and writes aren't synced to the disk one by one.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def get(self, key):
+        """
+        :param key: The key of the entry.
+        :type key: str
+        :returns: The value of the entry, or None if it isn't cached.
+        """
+
+        row = self._connection().execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value):
+        """
+        :param key: The key of the entry.
+        :type key: str
+        :param value: The value of the entry, which must be serializable to JSON.
+        """
+
+        connection = self._connection()
+
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?)', (key, json.dumps(value)))
+
+
+def statistics():
+    """
+    :returns: The statistics of the named caches, by name. The statistics
+    of the caches of the same name (e.g. one per repository) are summed,
+    including the counters of the caches already garbage collected.
+    :rtype: dict[str, dict[str, int]]
+    """
+
+    with _collected_lock:
+        totals = {name: dict(counters) for name, counters in _collected_counters.items()}
+
+    for cache in list(_named_caches):
+        total = totals.setdefault(cache.name, {})
+
+        for key, value in cache.stats().items():
+            total[key] = total.get(key, 0) + value
+
+    return totals
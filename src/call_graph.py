@@ -1,95 +1,551 @@
 import subprocess
 import tempfile
 import os
-import understand
-import json
+import shutil
+import numpy as np
+import profiling
+from cache import LRUCache
+from contextlib import contextmanager
 
 
-def _generate_understand_db(git, commit_hash, repo_path):
+# Methods further apart than this many calls are considered unrelated.
+MAX_DISTANCE = 10
+
+# The default size limit of the on-disk call graph cache, in bytes.
+DEFAULT_CACHE_SIZE = 1 << 30
+
+# The number of recently used call graphs also kept in memory, as the
+# next commit is usually updated from the call graph of its parent.
+MEMORY_CACHE_SIZE = 4
+
+
+class CallGraph(object):
+    """
+    A static call graph. Method names are interned to integer ids, and
+    the ids of the methods called by each method are stored back to back
+    in one array, with the offsets of each method in another.
+    """
+
+    def __init__(self, method_names, offsets, callees, method_files=None):
+        """
+        :param method_names: The name of each method id, in the full canonical form.
+        :type method_names: list[str]
+        :param offsets: The start of the callees of each method, plus the end
+        of the callees of the last method.
+        :type offsets: numpy.ndarray
+        :param callees: The ids of the methods called by each method, back to back.
+        :type callees: numpy.ndarray
+        :param method_files: The path of the file defining each method, relative
+        to the repository root, or None when unknown.
+        :type method_files: list[str | None] | None
+        """
+
+        self.method_names = method_names
+        self.offsets = offsets
+        self.callees = callees
+        self.method_files = method_files if method_files is not None else [None] * len(method_names)
+
+        self._method_ids = {name: i for i, name in enumerate(method_names)}
+
+    @classmethod
+    def from_edges(cls, method_names, callers, callees, method_files=None):
+        """
+        :param method_names: The name of each method id.
+        :type method_names: list[str]
+        :param callers: The id of the calling method of each call.
+        :type callers: list[int]
+        :param callees: The id of the called method of each call.
+        :type callees: list[int]
+        :param method_files: The path of the file defining each method, or None when unknown.
+        :type method_files: list[str | None] | None
+        :rtype: CallGraph
+        """
+
+        callers = np.array(callers, dtype=np.int64)
+        order = np.argsort(callers, kind='mergesort')
+
+        offsets = np.zeros(len(method_names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(callers, minlength=len(method_names)), out=offsets[1:])
+
+        return cls(method_names, offsets, np.array(callees, dtype=np.int32)[order], method_files)
+
+    def save(self, path):
+        """
+        Saves the call graph to a compressed file.
+        :param path: The path of the file, ending in .npz.
+        :type path: str
+        """
+
+        # File paths are interned, with -1 for unknown files.
+        file_ids = {}
+        method_file_ids = [-1 if f is None else file_ids.setdefault(f, len(file_ids)) for f in self.method_files]
+
+        np.savez_compressed(
+            path,
+            names=_encode_names(self.method_names),
+            offsets=self.offsets,
+            callees=self.callees,
+            files=_encode_names(list(file_ids)),
+            method_files=np.array(method_file_ids, dtype=np.int32)
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a call graph saved to a file.
+        :param path: The path of the file.
+        :type path: str
+        :rtype: CallGraph
+        """
+
+        with np.load(path) as data:
+            method_names = _decode_names(data['names'])
+            file_paths = _decode_names(data['files'])
+            method_files = [None if i < 0 else file_paths[i] for i in data['method_files'].tolist()]
+
+            return cls(method_names, data['offsets'], data['callees'], method_files)
+
+    def splice(self, changed_files, call_graph):
+        """
+        Replaces the calls made by the methods of some files with the
+        calls of a call graph of just those files.
+        :param changed_files: The paths of the files, relative to the repository root.
+        :type changed_files: set[str]
+        :param call_graph: The call graph of the methods defined in the files.
+        :type call_graph: CallGraph
+        :returns: The updated call graph.
+        :rtype: CallGraph
+        """
+
+        method_ids = dict(self._method_ids)
+        method_names = list(self.method_names)
+        method_files = list(self.method_files)
+
+        # Drop the calls made by the methods of the files.
+        changed_methods = np.array([f in changed_files for f in method_files], dtype=bool)
+        callers = np.repeat(np.arange(len(method_names)), np.diff(self.offsets))
+        kept = ~changed_methods[callers]
+
+        callers = callers[kept].tolist()
+        callees = self.callees[kept].tolist()
+
+        # Map the ids of the new call graph to the ids of this one.
+        new_ids = []
+
+        for name, file_path in zip(call_graph.method_names, call_graph.method_files):
+            method_id = method_ids.setdefault(name, len(method_names))
+
+            if method_id == len(method_names):
+                method_names.append(name)
+                method_files.append(file_path)
+            elif file_path is not None:
+                method_files[method_id] = file_path
+
+            new_ids.append(method_id)
+
+        new_ids = np.array(new_ids, dtype=np.int64)
+
+        callers += new_ids[np.repeat(np.arange(len(call_graph.method_names)), np.diff(call_graph.offsets))].tolist()
+        callees += new_ids[call_graph.callees].tolist()
+
+        return CallGraph.from_edges(method_names, callers, callees, method_files)
+
+    def distance_table(self, methods, max_distance=MAX_DISTANCE):
+        """
+        Calculates the length of the shortest call path between every
+        pair of methods, with one breadth first search from all of them
+        at once. Each method reached carries the set of searches that
+        reached it, as the bits of an integer.
+        :param methods: The names of distinct methods.
+        :type methods: list[str]
+        :param max_distance: The longest path to search for.
+        :type max_distance: int
+        :returns: The table of path lengths from each method (row) to each
+        method (column), -1 when there is no path short enough.
+        :rtype: numpy.ndarray
+        """
+
+        table = np.full((len(methods), len(methods)), -1, dtype=np.int32)
+        np.fill_diagonal(table, 0)
+
+        # The positions in the table of each method in the graph.
+        targets = {}
+        frontier = {}
+
+        for i, method in enumerate(methods):
+            method_id = self._method_ids.get(method)
+
+            if method_id is not None:
+                targets.setdefault(method_id, []).append(i)
+                frontier[method_id] = frontier.get(method_id, 0) | (1 << i)
+
+        reached = dict(frontier)
+
+        for distance in range(1, max_distance + 1):
+            next_frontier = {}
+
+            for method_id, searches in frontier.items():
+                for callee in self.callees[self.offsets[method_id]:self.offsets[method_id + 1]].tolist():
+                    new_searches = searches & ~reached.get(callee, 0)
+
+                    if new_searches:
+                        reached[callee] = reached.get(callee, 0) | new_searches
+                        next_frontier[callee] = next_frontier.get(callee, 0) | new_searches
+
+            for method_id, searches in next_frontier.items():
+                for target in targets.get(method_id, []):
+                    for source in _bits(searches):
+                        table[source, target] = distance
+
+            if not next_frontier:
+                break
+
+            frontier = next_frontier
+
+        return table
+
+
+class CallGraphCache(object):
+    """
+    Keeps call graphs on disk by commit hash, so that a commit is only
+    analysed once. When the cache grows past its size limit, the least
+    recently used call graphs are removed. The most recently used call
+    graphs are also kept in memory, so that they aren't loaded again.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE, memory_size=MEMORY_CACHE_SIZE):
+        """
+        :param directory: The directory to keep the call graphs in.
+        :type directory: str
+        :param max_size: The size limit of the cache, in bytes.
+        :type max_size: int
+        :param memory_size: The number of call graphs to keep in memory.
+        :type memory_size: int
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+        self.memory = LRUCache(memory_size, name='call_graphs')
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, commit_hash):
+        return os.path.join(self.directory, f'{commit_hash}.npz')
+
+    def get(self, commit_hash):
+        """
+        :param commit_hash: The full hash of the commit.
+        :type commit_hash: str
+        :returns: The cached call graph of the commit, or None.
+        :rtype: CallGraph | None
+        """
+
+        path = self._path(commit_hash)
+        call_graph = self.memory.get(commit_hash)
+
+        if call_graph is None:
+            try:
+                call_graph = CallGraph.load(path)
+            except (OSError, ValueError, KeyError):
+                return None
+
+            self.memory.put(commit_hash, call_graph)
+
+        # The modification time records when the call graph was last used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted from the disk by another process.
+            pass
+
+        return call_graph
+
+    def put(self, commit_hash, call_graph):
+        """
+        Adds the call graph of a commit to the cache.
+        :param commit_hash: The full hash of the commit.
+        :type commit_hash: str
+        :param call_graph: The call graph at this commit.
+        :type call_graph: CallGraph
+        """
+
+        path = self._path(commit_hash)
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+
+        call_graph.save(temp_path)
+        os.replace(temp_path, path)
+        self.memory.put(commit_hash, call_graph)
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used call graphs until the cache fits its size limit.
+        """
+
+        entries = []
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            size -= entry_size
+
+
+def _encode_names(names):
+    """
+    :param names: The names to encode.
+    :type names: list[str]
+    :returns: The names, one per line, as an array of UTF-8 bytes.
+    :rtype: numpy.ndarray
+    """
+
+    return np.frombuffer('\n'.join(names).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode_names(data):
+    """
+    :param data: The names encoded with _encode_names.
+    :type data: numpy.ndarray
+    :rtype: list[str]
+    """
+
+    names = data.tobytes().decode('utf-8')
+
+    return names.split('\n') if names else []
+
+
+def _bits(value):
+    """
+    :param value: A set of positions, as the bits of an integer.
+    :type value: int
+    :returns: The positions of the set bits.
+    :rtype: list[int]
     """
-    Generates the database file for Understand.
-    :param git: Reference to the git api access.
+
+    positions = []
+
+    while value:
+        lowest = value & -value
+        positions.append(lowest.bit_length() - 1)
+        value ^= lowest
+
+    return positions
+
+
+def _run_understand(*args):
+    """
+    Runs an Understand command, so that a failed step stops the analysis
+    rather than leaving a missing or partial database behind.
+    :param args: The arguments of the und command.
+    :type args: str
+    """
+
+    try:
+        process = subprocess.run(['und', *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError('Understand is not installed: und was not found on the PATH.') from None
+
+    if process.returncode:
+        error = process.stderr.decode('utf-8', errors='replace').strip()
+        raise RuntimeError(f'und {args[0]} failed with exit status {process.returncode}: {error}')
+
+
+@contextmanager
+def _understand_db(reader, commit_hash, files=None):
+    """
+    Generates the database file for Understand, from a snapshot of
+    the commit extracted to a scratch directory. The repository is
+    left untouched, so several commits can be analysed at once.
+    The snapshot and database are removed on exit.
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
     :param commit_hash: The hash of the commit to generate
     a call graph for.
     :type commit_hash: str
-    :param repo_path: The path of the repository on the file system.
-    :type repo_path: str
-    :returns: The path to the understand db.
-    :rtype: str
+    :param files: The paths of the only files to analyse, relative to
+    the repository root. All the files are analysed when None.
+    :type files: list[str] | None
+    :returns: The path to the understand db and the path to the snapshot.
+    :rtype: (str, str)
     """
 
-    # Checkout the files for the commit.
-    git.checkout(commit_hash)
-    
-    db_path = os.path.join(tempfile.gettempdir(), f'{commit_hash}.udb')
+    scratch_path = tempfile.mkdtemp(prefix=f'untangler-{commit_hash}-')
 
-    # TODO: Handle the case where understand is not installed,
-    # repo is missing, or we can't write to db_path
-    subprocess.run([
-        'und',
-        'create',
-        '-languages',
-        'java',
-        'add',
-        repo_path,
-        'analyze',
-        '-all',
-        db_path
-    ], stdout=subprocess.DEVNULL)
+    try:
+        snapshot_path = os.path.join(scratch_path, 'snapshot')
+        db_path = os.path.join(scratch_path, f'{commit_hash}.udb')
 
-    # Restore the repo to HEAD.
-    git.checkout('HEAD')
+        # Check the files of the commit out through an index of its own,
+        # rather than archiving them, which would apply export attributes.
+        with profiling.timer('understand.extract'):
+            env = {'GIT_INDEX_FILE': os.path.join(scratch_path, 'index')}
+            os.mkdir(snapshot_path)
 
-    return db_path
+            reader.run('read-tree', commit_hash, env=env)
+            reader.run(f'--work-tree={snapshot_path}', 'checkout-index', '--all', env=env)
 
+        with profiling.timer('understand.analyze'):
+            if files is None:
+                _run_understand('create', '-languages', 'java', 'add', snapshot_path, 'analyze', '-all', db_path)
+            else:
+                # All the files are added so that calls out of the analysed
+                # files can still be resolved.
+                _run_understand('create', '-languages', 'java', 'add', snapshot_path, db_path)
+                _run_understand('analyze', '-files', *[os.path.join(snapshot_path, f) for f in files], db_path)
 
-def generate_call_graph(git, commit_hash, repo_path):
+        yield db_path, snapshot_path
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+
+def _read_call_graph(udb_path, snapshot_path, files=None):
+    """
+    Reads the static call graph out of an Understand database.
+    :param udb_path: The path to the understand db.
+    :type udb_path: str
+    :param snapshot_path: The path of the analysed snapshot of the repository.
+    :type snapshot_path: str
+    :param files: The paths of the only files to read the calls of,
+    relative to the repository root. All calls are read when None.
+    :type files: set[str] | None
+    :rtype: CallGraph
+    """
+
+    method_ids = {}
+    method_files = []
+    callers = []
+    callees = []
+
+    def intern(name):
+        if name not in method_ids:
+            method_ids[name] = len(method_ids)
+            method_files.append(None)
+
+        return method_ids[name]
+
+    # Understand is only needed to build call graphs, and may not be installed.
+    import understand
+
+    db = understand.open(udb_path)
+
+    # Collect the calls between methods, with names in the form
+    # CLASS.METHOD_NAME interned to integer ids.
+    for fn in db.ents('function, method, procedure'):
+        definition = fn.ref('Definein')
+        file_path = None
+
+        if definition:
+            file_path = os.path.relpath(definition.file().longname(), snapshot_path).replace(os.sep, '/')
+
+        if files is not None and file_path not in files:
+            continue
+
+        caller_id = intern(fn.longname())
+        method_files[caller_id] = file_path
+
+        for called_fn in fn.refs('Java Call'):
+            callers.append(caller_id)
+            callees.append(intern(called_fn.ent().longname()))
+
+    db.close()
+
+    return CallGraph.from_edges(list(method_ids), callers, callees, method_files)
+
+
+def generate_call_graph(reader, commit_hash):
     """
     Generates a static call graph.
-    :param git: Reference to the git api access.
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
     :param commit_hash: The hash of the commit to generate
     a call graph for.
     :type commit_hash: str
-    :param repo_path: The path of the repository on the file system.
-    :type repo_path: str
-    :returns: The call graph at this commit. This is represented
-    as a dictionary of methods in the full canonical form mapped
-    to a list of methods called by that method in the same format.
-    :rtype: dict[str, list[str]]
+    :returns: The call graph at this commit, with methods in the full
+    canonical form.
+    :rtype: CallGraph
     """
 
-    call_graph = {}
-    udb_path = _generate_understand_db(git, commit_hash, repo_path)
+    with _understand_db(reader, commit_hash) as (udb_path, snapshot_path):
+        with profiling.timer('understand.read'):
+            return _read_call_graph(udb_path, snapshot_path)
 
-    db = understand.open(udb_path)
 
-    # Generate a mapping of method names in the form
-    # CLASS.METHOD_NAME to a list of methods that it calls.
-    for fn in db.ents('function, method, procedure'):                                         
-        function_name = fn.longname()
-        call_graph[function_name] = [called_fn.ent().longname() for called_fn in fn.refs('Java Call')]
+def update_call_graph(parent_call_graph, reader, parent_hash, commit_hash):
+    """
+    Generates a static call graph from the call graph of a parent commit,
+    by analysing only the files changed since the parent.
+    :param parent_call_graph: The call graph at the parent commit.
+    :type parent_call_graph: CallGraph
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
+    :param parent_hash: The hash of the parent commit.
+    :type parent_hash: str
+    :param commit_hash: The hash of the commit to generate
+    a call graph for.
+    :type commit_hash: str
+    :returns: The call graph at this commit.
+    :rtype: CallGraph
+    """
 
-    db.close()
+    # Renames are listed as a deletion and an addition. Paths are NUL
+    # separated, rather than quoted when they aren't ASCII.
+    changed_files = set(f for f in reader.run('diff', '--name-only', '--no-renames', '-z', parent_hash, commit_hash).split('\x00') if f.endswith('.java'))
 
-    # Clean up the temp file when done with it.
-    os.remove(udb_path)
+    if not changed_files:
+        return parent_call_graph
 
-    return call_graph
+    analysed_files = sorted(changed_files.intersection(reader.tree_entries(commit_hash)))
 
+    if analysed_files:
+        with _understand_db(reader, commit_hash, analysed_files) as (udb_path, snapshot_path):
+            with profiling.timer('understand.read'):
+                call_graph = _read_call_graph(udb_path, snapshot_path, set(analysed_files))
+    else:
+        call_graph = CallGraph.from_edges([], [], [])
 
-def generate_method_index(repo_path):
+    return parent_call_graph.splice(changed_files, call_graph)
+
+
+def load_call_graph(call_graph_cache, reader, commit_hash):
     """
-    Generates an index of the line numbers each method occupies.
-    :param repo_path: The path of the repository on the file system.
-    :type repo_path: str
-    :returns: An index of the line numbers each method occupies.
-    :rtype: dict[str, list[dict[str, str | int]]]
+    Gets the static call graph of a commit from the cache. Otherwise, it
+    is updated from the cached call graph of the first parent, or generated,
+    and then cached.
+    :param call_graph_cache: The cache of call graphs.
+    :type call_graph_cache: CallGraphCache
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
+    :param commit_hash: The full hash of the commit to get the call graph of.
+    :type commit_hash: str
+    :rtype: CallGraph
     """
 
-    index_json_str = subprocess.check_output([
-        'java_method_indexer.bat',
-        '-project_root',
-        repo_path
-    ])
+    call_graph = call_graph_cache.get(commit_hash)
+
+    if call_graph is not None:
+        return call_graph
 
-    return json.loads(index_json_str)
+    parents = reader.parents(commit_hash)
+    parent_call_graph = call_graph_cache.get(parents[0]) if parents else None
+
+    if parent_call_graph is not None:
+        call_graph = update_call_graph(parent_call_graph, reader, parents[0], commit_hash)
+    else:
+        call_graph = generate_call_graph(reader, commit_hash)
+
+    call_graph_cache.put(commit_hash, call_graph)
+
+    return call_graph
@@ -1,8 +1,11 @@
 class Change(object):
     """
-    Represents a single line level change.
+    Represents a single line level change. Commits can have many,
+    so changes only have slots rather than a dictionary.
     """
-    
+
+    __slots__ = ('operation', 'line', 'line_number', 'source_file_snapshot')
+
     def __init__(self, operation, line, line_number, source_file_snapshot):
         """
         :param operation: The operation of this change.
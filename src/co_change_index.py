@@ -0,0 +1,395 @@
+"""An index of the commits each file of a repository was changed in."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import git_reader
+
+
+# Bump when the indexed paths change, so that cached indexes are rebuilt.
+INDEX_VERSION = 2
+
+
+class CoChangeIndex(object):
+    """
+    Maps each file path (relative to the repository root) to the sorted
+    ids of the commits that changed it. Commits are numbered from the
+    oldest (0) to the newest. The ids of all the files are stored back to
+    back in one array, with the offsets of each file in another.
+    """
+
+    def __init__(self, file_paths, offsets, commits, head, commit_count):
+        """
+        :param file_paths: The indexed file paths, sorted.
+        :type file_paths: list[str]
+        :param offsets: The start of the commits of each file, plus the end
+        of the commits of the last file.
+        :type offsets: numpy.ndarray
+        :param commits: The commit ids of each file, back to back.
+        :type commits: numpy.ndarray
+        :param head: The hash of the newest indexed commit.
+        :type head: str | None
+        :param commit_count: The number of indexed commits.
+        :type commit_count: int
+        """
+
+        self.file_paths = file_paths
+        self.offsets = offsets
+        self.commits = commits
+        self.head = head
+        self.commit_count = commit_count
+
+        self._file_ids = {path: i for i, path in enumerate(file_paths)}
+
+    @classmethod
+    def build(cls, repo, rev='HEAD', since=None, max_count=None):
+        """
+        Builds the index from a single walk of the history.
+        :param repo: The repository.
+        :type repo: git.Repo
+        :param rev: The revision to walk the history from.
+        :type rev: str
+        :param since: Only index commits more recent than this date.
+        :type since: str | None
+        :param max_count: Only index this many of the most recent commits.
+        :type max_count: int | None
+        :rtype: CoChangeIndex
+        """
+
+        options = []
+
+        if since:
+            options.append(f'--since={since}')
+
+        if max_count:
+            options.append(f'--max-count={max_count}')
+
+        file_commits, head, commit_count = _read_log(repo, 0, *options, rev)
+
+        return cls.from_file_commits(file_commits, head, commit_count)
+
+    @classmethod
+    def from_file_commits(cls, file_commits, head, commit_count):
+        """
+        :param file_commits: The sorted commit ids of each file.
+        :type file_commits: dict[str, list[int]]
+        :param head: The hash of the newest indexed commit.
+        :type head: str | None
+        :param commit_count: The number of indexed commits.
+        :type commit_count: int
+        :rtype: CoChangeIndex
+        """
+
+        file_paths = sorted(file_commits)
+        lengths = np.array([len(file_commits[path]) for path in file_paths], dtype=np.int64)
+
+        offsets = np.zeros(len(file_paths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        commits = np.empty(offsets[-1], dtype=np.int32)
+
+        for i, path in enumerate(file_paths):
+            commits[offsets[i]:offsets[i + 1]] = file_commits[path]
+
+        return cls(file_paths, offsets, commits, head, commit_count)
+
+    @classmethod
+    def open(cls, repo, cache_dir, rev='HEAD', since=None, max_count=None):
+        """
+        Loads the index of a repository from the cache directory, and
+        brings it up to date by indexing only the commits newer than the
+        last indexed commit. The index is built and saved if it isn't cached
+        yet, or if the last indexed commit is no longer in the history.
+
+        The history window (since, max_count) is part of the cache key
+        and only applies to the first build: newer commits are always added.
+
+        :param repo: The repository.
+        :type repo: git.Repo
+        :param cache_dir: The directory the indexes are cached in.
+        :type cache_dir: str
+        :param rev: The revision to walk the history from.
+        :type rev: str
+        :param since: Only index commits more recent than this date.
+        :type since: str | None
+        :param max_count: Only index this many of the most recent commits.
+        :type max_count: int | None
+        :rtype: CoChangeIndex
+        """
+
+        key = f'{os.path.abspath(repo.git_dir)}:{since}:{max_count}:v{INDEX_VERSION}'
+        directory = os.path.join(cache_dir, 'co_change', hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+        try:
+            index = cls.load(directory)
+        except (OSError, ValueError, KeyError):
+            # Not cached yet, or the saved version was removed by a concurrent save.
+            index = None
+
+        if index is not None:
+            if index.head is not None and _is_ancestor(repo, index.head, rev):
+                if index.update(repo, rev):
+                    index.save(directory)
+
+                return index
+
+        index = cls.build(repo, rev, since, max_count)
+        index.save(directory)
+
+        return index
+
+    def update(self, repo, rev='HEAD'):
+        """
+        Adds the commits newer than the last indexed commit to the index.
+        The last indexed commit must be an ancestor of the revision.
+        :param repo: The repository.
+        :type repo: git.Repo
+        :param rev: The revision to walk the history from.
+        :type rev: str
+        :returns: Whether the index changed.
+        :rtype: bool
+        """
+
+        file_commits, head, commit_count = _read_log(repo, self.commit_count, f'{self.head}..{rev}')
+
+        if not commit_count:
+            return False
+
+        file_paths = sorted(set(self.file_paths).union(file_commits))
+        file_ids = {path: i for i, path in enumerate(file_paths)}
+
+        # The file id of each existing entry, followed by the new entries.
+        # New commits have larger ids, so a stable sort by file id keeps
+        # the commits of each file sorted.
+        old_file_ids = np.array([file_ids[path] for path in self.file_paths], dtype=np.int64)
+        entry_files = [np.repeat(old_file_ids, np.diff(self.offsets))]
+        entry_commits = [np.asarray(self.commits)]
+
+        for path, commits in file_commits.items():
+            entry_files.append(np.full(len(commits), file_ids[path], dtype=np.int64))
+            entry_commits.append(np.array(commits, dtype=np.int32))
+
+        entry_files = np.concatenate(entry_files)
+        order = np.argsort(entry_files, kind='mergesort')
+
+        offsets = np.zeros(len(file_paths) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_files, minlength=len(file_paths)), out=offsets[1:])
+
+        self.__init__(file_paths, offsets, np.concatenate(entry_commits)[order], head, self.commit_count + commit_count)
+
+        return True
+
+    def save(self, directory):
+        """
+        Saves the index to a directory, in a format that can be memory-mapped.
+
+        Each save writes a new version of the index to a subdirectory of its
+        own, then points the directory at it by replacing the file current,
+        in one atomic rename. An interrupted save, or saves of several
+        processes at once, never leave a mix of versions behind. Versions
+        older than the one replaced are removed.
+        :param directory: The directory to save the index to.
+        :type directory: str
+        """
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Versions are named in the order they are saved, and unique across processes.
+        version_path = tempfile.mkdtemp(prefix=f'{time.time_ns():020d}-', dir=directory)
+        version = os.path.basename(version_path)
+
+        with open(os.path.join(version_path, 'file_paths.txt'), 'wb') as f:
+            f.write('\x00'.join(self.file_paths).encode('utf-8', errors='surrogateescape'))
+
+        np.save(os.path.join(version_path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(version_path, 'commits.npy'), self.commits)
+
+        with open(os.path.join(version_path, 'meta.json'), 'w') as f:
+            json.dump({'head': self.head, 'commit_count': self.commit_count}, f)
+
+        previous = _current_version(directory)
+        pointer_path = os.path.join(directory, f'current.{version}.tmp')
+
+        with open(pointer_path, 'w') as f:
+            f.write(version)
+
+        os.replace(pointer_path, os.path.join(directory, 'current'))
+
+        # The replaced version may still be loaded by another process.
+        # Memory-mapped files of removed versions stay readable.
+        for entry in os.listdir(directory):
+            if previous and entry < previous and os.path.isdir(os.path.join(directory, entry)):
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Loads the current version of an index saved to a directory. The commit ids are memory-mapped.
+        :param directory: The directory the index was saved to.
+        :type directory: str
+        :rtype: CoChangeIndex
+        """
+
+        version = _current_version(directory)
+
+        if version is None:
+            raise FileNotFoundError(os.path.join(directory, 'current'))
+
+        version_path = os.path.join(directory, version)
+
+        with open(os.path.join(version_path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        with open(os.path.join(version_path, 'file_paths.txt'), 'rb') as f:
+            file_paths = f.read().decode('utf-8', errors='surrogateescape').split('\x00')
+
+        offsets = np.load(os.path.join(version_path, 'offsets.npy'))
+        commits = np.load(os.path.join(version_path, 'commits.npy'), mmap_mode='r')
+
+        if len(offsets) == 1:
+            file_paths = []
+
+        return cls(file_paths, offsets, commits, meta['head'], meta['commit_count'])
+
+    def commits_of(self, file_path):
+        """
+        :param file_path: The path of the file, relative to the repository root.
+        :type file_path: str
+        :returns: The sorted ids of the commits that changed the file.
+        :rtype: numpy.ndarray
+        """
+
+        file_id = self._file_ids.get(file_path)
+
+        if file_id is None:
+            return self.commits[:0]
+
+        return self.commits[self.offsets[file_id]:self.offsets[file_id + 1]]
+
+    def frequency(self, file_a, file_b):
+        """
+        Calculates the frequency at which two files are changed together,
+        that is the number of commits changing both files divided by the
+        number of commits changing either.
+        :param file_a: The path of the first file, relative to the repository root.
+        :type file_a: str
+        :param file_b: The path of the second file, relative to the repository root.
+        :type file_b: str
+        :rtype: float
+        """
+
+        commits_a = self.commits_of(file_a)
+        commits_b = self.commits_of(file_b)
+
+        if len(commits_a) > len(commits_b):
+            commits_a, commits_b = commits_b, commits_a
+
+        if not len(commits_a):
+            return 0.0
+
+        # Look the commits of the smaller file up in the sorted commits of the other.
+        positions = np.minimum(np.searchsorted(commits_b, commits_a), len(commits_b) - 1)
+        common = int(np.count_nonzero(commits_b[positions] == commits_a))
+
+        return float(common) / float(len(commits_a) + len(commits_b) - common)
+
+
+def _read_log(repo, first_commit_id, *options):
+    """
+    Reads the files changed by each commit of the history in a single git log.
+    :param repo: The repository.
+    :type repo: git.Repo
+    :param first_commit_id: The id to give the oldest read commit.
+    :type first_commit_id: int
+    :param options: The options and revisions to pass to git log.
+    :type options: str
+    :returns: The sorted ids of the read commits that changed each file,
+    the hash of the newest read commit and the number of read commits.
+    :rtype: (dict[str, list[int]], str | None, int)
+    """
+
+    # Each record is the hash of a commit, marked with \x01, followed by the
+    # files it changed, newest first. Records are numbered in that order
+    # while streaming. Fields are separated by NUL, so that paths aren't
+    # quoted, and the first path of a record starts with a newline.
+    newest_file_commits = {}
+    head = None
+    record_count = 0
+
+    with git_reader.for_repo(repo).stream('log', '--name-only', '-z', '--format=%x01%H', *options) as log:
+        for field in _split_fields(log):
+            if field.startswith(b'\x01'):
+                if head is None:
+                    head = field[1:].decode('ascii')
+
+                record_count += 1
+                continue
+
+            if field.startswith(b'\n'):
+                field = field[1:]
+
+            if field:
+                newest_file_commits.setdefault(field.decode('utf-8', errors='surrogateescape'), []).append(record_count - 1)
+
+    # Renumber the commits from the oldest.
+    last_commit_id = first_commit_id + record_count - 1
+    file_commits = {path: [last_commit_id - k for k in reversed(records)] for path, records in newest_file_commits.items()}
+
+    return file_commits, head, record_count
+
+
+def _split_fields(stream, chunk_size=1 << 16):
+    """
+    :param stream: The output of a git command run with -z.
+    :type stream: io.BufferedReader
+    :param chunk_size: The number of bytes to read at once.
+    :type chunk_size: int
+    :returns: The NUL separated fields of the output, read a chunk at a time.
+    :rtype: collections.abc.Iterator[bytes]
+    """
+
+    rest = b''
+
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        fields = (rest + chunk).split(b'\x00')
+        rest = fields.pop()
+
+        yield from fields
+
+    if rest:
+        yield rest
+
+
+def _current_version(directory):
+    """
+    :param directory: The directory an index is saved to.
+    :type directory: str
+    :returns: The name of the current version of the index, or None when it isn't saved.
+    :rtype: str | None
+    """
+
+    try:
+        with open(os.path.join(directory, 'current')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _is_ancestor(repo, ancestor, rev):
+    """
+    :param repo: The repository.
+    :type repo: git.Repo
+    :param ancestor: The hash of the potential ancestor.
+    :type ancestor: str
+    :param rev: The revision.
+    :type rev: str
+    :returns: Whether the commit is an ancestor of the revision (or the revision itself).
+    :rtype: bool
+    """
+
+    # Fails when the history was rewritten, or the commit no longer exists.
+    return git_reader.for_repo(repo).run('merge-base', '--is-ancestor', ancestor, rev, check=False) == 0
@@ -1,7 +1,9 @@
 """Splits a commit into individual line level changes."""
 
+import codecs
+import git_reader
 from change import Change
-from source_file import SourceFileSnapshot
+from source_file import snapshot_files
 
 
 def collect_changes(repo, commit, repo_path):
@@ -26,28 +28,110 @@ def collect_changes(repo, commit, repo_path):
     :rtype: list[change.Change]
     """
 
+    reader = git_reader.for_repo(repo)
+
+    # The commit and path of the file of each change: deleted lines are in
+    # the file of the parent, added lines in the file of the commit. The
+    # snapshots of the files of each commit are created at once, once known.
     changes = []
+    file_paths = []
+    commits = [commit]
+
+    for parent in reader.parents(commit.hexsha):
+        # The same options as GitPython's diffs, with explicit prefixes
+        # so that the user's configuration can't change the headers.
+        patch_args = ['diff-tree', '-r', '-M', '-p', '--no-ext-diff', '--no-color', '--src-prefix=a/', '--dst-prefix=b/', parent, commit.hexsha]
+        commits.append(repo.commit(parent))
+
+        with reader.stream(*patch_args) as patch:
+            for operation, line, line_number, file_path in parse_patch(patch):
+                changes.append(Change(operation, line, line_number, None))
+                file_paths.append((len(commits) - 1 if operation == 'del' else 0, file_path))
+
+    snapshots = {}
+
+    for k, snapshot_commit in enumerate(commits):
+        paths = [file_path for j, file_path in file_paths if j == k]
+
+        for file_path, snapshot in snapshot_files(repo, snapshot_commit, repo_path, paths).items():
+            snapshots[k, file_path] = snapshot
 
-    for parent in commit.parents:
-        for d in parent.diff(commit, create_patch=True):
-            diff = d.diff.decode('utf-8')
-
-            for change in diff.split('\n'):
-                if change.startswith('@@'):
-                    info = [x for x in change.split() if x != '@@']
-                    # Parse the beginning line numbers of the unified diff.
-                    old_line_number = int(info[0][1:].split(',')[0])
-                    new_line_number = int(info[1][1:].split(',')[0])
-                elif change.startswith('-'):
-                    changes.append(Change('del', change[1:], old_line_number, SourceFileSnapshot(d.a_path, repo, commit, repo_path)))
-                    old_line_number += 1
-                elif change.startswith('+'):
-                    changes.append(Change('add', change[1:], new_line_number, SourceFileSnapshot(d.b_path, repo, commit, repo_path)))
-                    new_line_number += 1
-                elif change == '\\ No newline at end of file':
-                    continue
-                else:
-                    old_line_number += 1
-                    new_line_number += 1
+    for change, key in zip(changes, file_paths):
+        change.source_file_snapshot = snapshots[key]
 
     return changes
+
+
+def parse_patch(patch):
+    """
+    Parses the added and deleted lines out of a patch, one line of the
+    patch at a time. Only the paths and the changed lines are decoded.
+    Lines replace what isn't valid UTF-8, while paths keep it as surrogates,
+    like the paths listed by git_reader. Binary files have no lines in patches.
+    :param patch: The lines of the patch, as output by git diff.
+    :type patch: collections.abc.Iterable[bytes]
+    :returns: The operation ('add' or 'del'), contents, line number and
+    path of each changed line. Deleted lines have the old path and line
+    number, added lines have the new ones.
+    :rtype: collections.abc.Iterator[(str, str, int, str)]
+    """
+
+    old_path = new_path = None
+    old_line_number = new_line_number = 0
+    in_hunk = False
+
+    for line in patch:
+        if in_hunk:
+            marker = line[:1]
+
+            if marker == b'-':
+                yield 'del', line[1:].rstrip(b'\n').decode('utf-8', errors='replace'), old_line_number, old_path
+                old_line_number += 1
+                continue
+            elif marker == b'+':
+                yield 'add', line[1:].rstrip(b'\n').decode('utf-8', errors='replace'), new_line_number, new_path
+                new_line_number += 1
+                continue
+            elif marker == b' ':
+                old_line_number += 1
+                new_line_number += 1
+                continue
+            elif marker == b'\\':
+                # "\ No newline at end of file"
+                continue
+
+        if line.startswith(b'@@'):
+            # Parse the beginning line numbers of the unified diff,
+            # e.g. "@@ -12,5 +12,7 @@".
+            info = line.split()
+            old_line_number = int(info[1][1:].split(b',')[0])
+            new_line_number = int(info[2][1:].split(b',')[0])
+            in_hunk = True
+        elif line.startswith(b'diff '):
+            old_path = new_path = None
+            in_hunk = False
+        elif line.startswith(b'--- '):
+            old_path = _parse_path(line[4:])
+        elif line.startswith(b'+++ '):
+            new_path = _parse_path(line[4:])
+
+
+def _parse_path(header):
+    """
+    :param header: The path in a ---/+++ line of a patch.
+    :type header: bytes
+    :returns: The path without its a/ or b/ prefix, or None for /dev/null.
+    :rtype: str | None
+    """
+
+    # Paths with spaces are followed by a tab.
+    header = header.rstrip(b'\n').rstrip(b'\t')
+
+    if header == b'/dev/null':
+        return None
+
+    # Paths with special characters are quoted, with C-style escapes.
+    if header.startswith(b'"'):
+        header = codecs.escape_decode(header[1:-1])[0]
+
+    return header[2:].decode('utf-8', errors='surrogateescape')
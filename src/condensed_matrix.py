@@ -0,0 +1,203 @@
+"""A compact representation of the symmetric change matrix."""
+
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+
+class CondensedMatrix(object):
+    """
+    Represents a symmetric matrix of change pair scores, indexed by
+    integer change ids. Only the upper triangle (without the diagonal)
+    is stored, row by row, as float32 values. Missing scores are NaN.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, size, path=None, shared=False):
+        """
+        :param size: The number of changes.
+        :type size: int
+        :param path: An optional file to memory-map the values to,
+        for matrices that don't fit in memory.
+        :type path: str | None
+        :param shared: Whether to keep the values in shared memory, so that
+        other processes can write to them (see attach).
+        :type shared: bool
+        """
+
+        self.size = size
+        self.path = path
+        self.shared_memory = None
+
+        length = size * (size - 1) // 2
+
+        if path and length:
+            self.values = np.memmap(path, dtype=self.dtype, mode='w+', shape=(length,))
+        elif shared and length:
+            self.shared_memory = SharedMemory(create=True, size=length * np.dtype(self.dtype).itemsize)
+            self.values = np.ndarray((length,), dtype=self.dtype, buffer=self.shared_memory.buf)
+        else:
+            self.values = np.empty(length, dtype=self.dtype)
+
+        self.values[:] = np.nan
+        self._row_starts = _row_starts(size)
+
+    @classmethod
+    def attach(cls, size, path=None, shared_name=None):
+        """
+        Opens the values of a matrix created by another process, for writing.
+        :param size: The number of changes.
+        :type size: int
+        :param path: The file the values are memory-mapped to, if any.
+        :type path: str | None
+        :param shared_name: The name of the shared memory holding the values, if any.
+        :type shared_name: str | None
+        :rtype: CondensedMatrix
+        """
+
+        change_matrix = cls.__new__(cls)
+        change_matrix.size = size
+        change_matrix.path = path
+        change_matrix.shared_memory = None
+
+        length = size * (size - 1) // 2
+
+        if path and length:
+            change_matrix.values = np.memmap(path, dtype=cls.dtype, mode='r+', shape=(length,))
+        elif shared_name and length:
+            change_matrix.shared_memory = SharedMemory(name=shared_name)
+            change_matrix.values = np.ndarray((length,), dtype=cls.dtype, buffer=change_matrix.shared_memory.buf)
+        else:
+            change_matrix.values = np.empty(length, dtype=cls.dtype)
+
+        change_matrix._row_starts = _row_starts(size)
+
+        return change_matrix
+
+    @property
+    def shared_name(self):
+        """
+        :returns: The name of the shared memory holding the values, if any.
+        :rtype: str | None
+        """
+
+        return self.shared_memory.name if self.shared_memory else None
+
+    def unshare(self):
+        """
+        Moves the values out of shared memory, once other processes are
+        done writing to them, and releases the shared memory.
+        """
+
+        if self.shared_memory:
+            self.values = np.array(self.values)
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+
+    def __len__(self):
+        return self.size
+
+    def index(self, i, j):
+        """
+        Calculates the position of a pair in the condensed values.
+        :param i: The id of the first change.
+        :type i: int
+        :param j: The id of the second change. Must differ from i.
+        :type j: int
+        :rtype: int
+        """
+
+        if i > j:
+            i, j = j, i
+
+        return int(self._row_starts[i]) + j - i - 1
+
+    def pairs(self, indices):
+        """
+        Finds the pairs of change ids stored at positions in the condensed values.
+        :param indices: The positions in the condensed values.
+        :type indices: numpy.ndarray
+        :returns: The ids of the first and second change of each pair.
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+
+        rows = np.searchsorted(self._row_starts, indices, side='right') - 1
+
+        return rows, indices - self._row_starts[rows] + rows + 1
+
+    def row_slice(self, i):
+        """
+        :param i: The id of a change.
+        :type i: int
+        :returns: The slice of the values holding the pairs (i, j) for all j > i.
+        :rtype: slice
+        """
+
+        start = int(self._row_starts[i])
+
+        return slice(start, start + self.size - i - 1)
+
+    def row_indices(self, i):
+        """
+        :param i: The id of a change.
+        :type i: int
+        :returns: The positions in the condensed values of the pairs (i, j)
+        for all j, with -1 for the pair (i, i).
+        :rtype: numpy.ndarray
+        """
+
+        others = np.arange(self.size, dtype=np.int64)
+        low = np.minimum(others, i)
+        high = np.maximum(others, i)
+
+        indices = self._row_starts[low] + high - low - 1
+        indices[i] = -1
+
+        return indices
+
+    def row(self, i):
+        """
+        :param i: The id of a change.
+        :type i: int
+        :returns: The scores of the change with all the changes (NaN with itself).
+        :rtype: numpy.ndarray
+        """
+
+        indices = self.row_indices(i)
+        row = self.values[indices]
+        row[i] = np.nan
+
+        return row
+
+    def __getitem__(self, pair):
+        i, j = pair
+
+        if i == j:
+            return np.nan
+
+        return self.values[self.index(i, j)]
+
+    def __setitem__(self, pair, value):
+        self.values[self.index(*pair)] = value
+
+    def flush(self):
+        """
+        Writes the values to the backing file, if any.
+        """
+
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+
+
+def _row_starts(size):
+    """
+    :param size: The number of changes.
+    :type size: int
+    :returns: The position of the first value of each row in the condensed values.
+    :rtype: numpy.ndarray
+    """
+
+    rows = np.arange(size, dtype=np.int64)
+
+    return rows * (2 * size - rows - 1) // 2
@@ -4,11 +4,7 @@ from change import Change
 import math
 import git_tree
 import os
-from collections import deque
-
-
-diameter_cache = {}
-co_change_cache = {}
+import numpy as np
 
 
 def calculate_file_distance(change_a, change_b):
@@ -17,6 +13,8 @@ def calculate_file_distance(change_a, change_b):
     The file distance is defined as the number of lines
     between the two change operations, divided by the length
     of the source file in lines at the time of this change.
+    Deleted lines are in the file before the change, so pairs
+    of deleted and added lines use the longer of the two.
 
     If the two changes are not in the same file, the file
     distance will be the maximum value, 1.
@@ -28,7 +26,9 @@ def calculate_file_distance(change_a, change_b):
     """
 
     if change_a.source_file_snapshot.file_path == change_b.source_file_snapshot.file_path:
-        return math.fabs(change_a.line_number - change_b.line_number) / change_a.source_file_snapshot.line_length
+        line_length = max(change_a.source_file_snapshot.line_length, change_b.source_file_snapshot.line_length)
+
+        return math.fabs(change_a.line_number - change_b.line_number) / line_length
     else:
         return 1
 
@@ -52,136 +52,125 @@ def calculate_package_distance(tree, change_a, change_b):
     :type change_b: change.Change
     """
 
-    if change_a.source_file_snapshot.file_path == change_b.source_file_snapshot.file_path:
-        return 0
-    else:
-        diameter = diameter_cache.get(tree)
-
-        if not diameter:
-            # Cache the diameter so we don't recalculate each time.
-            diameter = git_tree.calculate_diameter(tree)
-            diameter_cache[tree] = diameter
-
-        distance = git_tree.calculate_distance(tree, change_a.source_file_snapshot, change_b.source_file_snapshot)
-
-        return float(distance) / float(diameter)
+    return package_distance(tree, change_a.source_file_snapshot, change_b.source_file_snapshot)
 
 
-def _bfs(src, target, graph):
+def package_distance(tree, file_a, file_b):
     """
-    Calculates the shortest path from src to target using BFS.
-    :param src: The source node.
-    :type src: str
-    :param target: The target node.
-    :type target: str
-    :param graph: The graph to search.
-    :type graph: dict[str, list[str]]
-    :returns: The shortest path between the two nodes.
-    :rtype: int
+    Calculates the package distance between two source files.
+    See calculate_package_distance.
+    :param tree: The file tree.
+    :type tree: git.objects.tree.Tree
+    :param file_a: The first file to consider.
+    :type file_a: source_file.SourceFileSnapshot
+    :param file_b: The second file to consider.
+    :type file_b: source_file.SourceFileSnapshot
+    :rtype: float
     """
 
-    curr = src
-    queue = deque()
-    distances = {src: 0}
-
-    if src == target:
+    if file_a.file_path == file_b.file_path:
         return 0
+    else:
+        # The tree index is built once per tree, and holds the diameter.
+        tree_index = git_tree.index_tree(tree)
+        distance = tree_index.distance(file_a.relative_path, file_b.relative_path)
 
-    while queue:
-        for neighbour in graph[curr]:
-            if neighbour not in distances:
-                distances[neighbour] = distances[curr] + 1
-
-                if neighbour == target:
-                    return distances[neighbour]
-                else:
-                    queue.append(neighbour)
-
-    # There is no path between the two nodes.
-    return -1
+        return float(distance) / float(tree_index.diameter)
 
 
-def calculate_call_graph_distance(static_call_graph, method_index, change_a, change_b):
+def calculate_call_graph_distance(static_call_graph, method_lookup, change_a, change_b):
     """
     Calcualates the distance between two changes in the call graph.
     This value is defined as 1 divided by the number of edges between the two nodes.
     :param static_call_graph: The static call graph to traverse.
-    :type static_call_graph: dict[str, list[str]]
-    :param method_index: An index of all the methods and line numbers they occupy.
-    :type method_index: dict[str, dict[str, str | int]]
+    :type static_call_graph: call_graph.CallGraph
+    :param method_lookup: The lookup of the methods enclosing each line.
+    :type method_lookup: method_lookup.MethodLookup
     :param change_a: The first change to consider.
     :type change_a: change.Change
     :param change_b: The second change to consider.
     :type change_b: change.Change
     """
 
-    ln_a = change_a.line_number
-    ln_b = change_b.line_number
+    method_a = method_lookup.find(change_a.source_file_snapshot.sha, change_a.line_number)
+    method_b = method_lookup.find(change_b.source_file_snapshot.sha, change_b.line_number)
+
+    if not method_a or not method_b:
+        # This means that one of the changes isn't in a method,
+        # or that its file is not likely code.
+        return -1
+
+    return method_distance(static_call_graph, method_a, method_b)
+
+
+def method_distance(static_call_graph, method_a, method_b):
+    """
+    Calculates the call graph distance between two methods.
+    See calculate_call_graph_distance.
+    :param static_call_graph: The static call graph to traverse.
+    :type static_call_graph: call_graph.CallGraph
+    :param method_a: The first method to consider.
+    :type method_a: str
+    :param method_b: The second method to consider.
+    :type method_b: str
+    :rtype: float
+    """
+
+    if method_a == method_b:
+        return 0
 
-    method_a = None
-    method_b = None
+    shortest_paths = static_call_graph.distance_table([method_a, method_b])
 
-    try:
-        for line_range, method_name in method_index[change_a.source_file_snapshot.file_path].items():
-            lines = [int(l) for l in line_range.split('-')]
+    return float(call_graph_votes(shortest_paths)[0, 1])
 
-            if ln_a >= lines[0] and ln_a <= lines[1]:
-                method_a = method_name
-                break
 
-        for line_range, method_name in method_index[change_b.source_file_snapshot.file_path].items():
-            lines = [int(l) for l in line_range.split('-')]
+def call_graph_votes(shortest_paths):
+    """
+    Calculates the call graph distance of method pairs from the length
+    of the shortest call path between them, in either direction.
+    :param shortest_paths: The table of path lengths from each method (row)
+    to each method (column), -1 when there is no path.
+    :type shortest_paths: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
 
-            if ln_b >= lines[0] and ln_b <= lines[1]:
-                method_b = method_name
-                break
+    # Calls go one way, so the shorter direction is used.
+    forward = np.where(shortest_paths < 0, np.iinfo(np.int32).max, shortest_paths)
+    shortest_path = np.minimum(forward, forward.T)
 
-        if not method_a or not method_b:
-            # This means that one of the changes isn't in a method.
-            return -1
+    with np.errstate(divide='ignore'):
+        votes = 1 - (1.0 / shortest_path)
 
-        # Now we have the keys in the static call graph, we can now look for the distance.
-        shortest_path = _bfs(method_a, method_b, static_call_graph)
+    votes[shortest_path == 0] = 0
+    votes[shortest_path == np.iinfo(np.int32).max] = 1
 
-        if shortest_path == -1:
-            return 1
-        elif shortest_path == 0:
-            return 0
-        else:
-            return 1 - (1.0 / shortest_path)
-    except KeyError:
-        # This happens when the file is not likely code.
-        return -1
+    return votes
 
 
-def calculate_co_change_frequency(repo, change_a, change_b):
+def calculate_co_change_frequency(co_change_index, change_a, change_b):
     """
     Calculates the frequency at which two files are changed together.
-    :param repo: The repository.
-    :type repo: git.Repo
+    :param co_change_index: The index of the commits each file was changed in.
+    :type co_change_index: co_change_index.CoChangeIndex
     :param change_a: The first change to consider.
     :type change_a: change.Change
     :param change_b: The second change to consider.
     :type change_b: change.Change
     """
 
-    git = repo.git
-    file_a = change_a.source_file_snapshot.file_path
-    file_b = change_b.source_file_snapshot.file_path
-
-    key = frozenset([file_a, file_b])
-
-    if key not in co_change_cache:
-        file_a_commits = set([repo.commit(x.split()[0]) for x in git.log('--oneline', '--follow', file_a).split('\n')])
-        file_b_commits = set([repo.commit(x.split()[0]) for x in git.log('--oneline', '--follow', file_b).split('\n')])
+    return co_change_distance(co_change_index, change_a.source_file_snapshot.relative_path, change_b.source_file_snapshot.relative_path)
 
-        all_commits = file_a_commits.union(file_b_commits)
-        common_commits = file_a_commits.intersection(file_b_commits)
 
-        co_change_frequency = float(len(common_commits)) / float(len(all_commits))
-
-        co_change_cache[key] = co_change_frequency
-    else:
-        co_change_frequency = co_change_cache[key]
+def co_change_distance(co_change_index, file_a, file_b):
+    """
+    Calculates 1 minus the frequency at which two files are changed together.
+    :param co_change_index: The index of the commits each file was changed in.
+    :type co_change_index: co_change_index.CoChangeIndex
+    :param file_a: The path of the first file, relative to the repository root.
+    :type file_a: str
+    :param file_b: The path of the second file, relative to the repository root.
+    :type file_b: str
+    :rtype: float
+    """
 
-    return 1 - co_change_frequency
+    return 1 - co_change_index.frequency(file_a, file_b)
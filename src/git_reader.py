@@ -0,0 +1,334 @@
+"""Reads git objects through long-lived git processes shared by every module."""
+
+import os
+import subprocess
+import tempfile
+import threading
+from cache import LRUCache
+from contextlib import contextmanager
+from git.exc import GitCommandError
+
+
+# The default number of bytes of object contents kept in memory per repository.
+DEFAULT_CACHE_SIZE = 64 << 20
+
+# The number of tree listings kept in memory per repository.
+TREE_CACHE_SIZE = 8
+
+# The reader of each repository, by git directory, see for_repo.
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def _forget_readers():
+    """
+    Makes a forked process start its own readers, rather than sharing
+    the pipes of its parent's cat-file processes.
+    """
+
+    global _readers, _readers_lock
+
+    _readers = {}
+    _readers_lock = threading.Lock()
+
+
+# Windows can't fork, and has no fork hooks.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_readers)
+
+
+def for_repo(repo):
+    """
+    Gets the reader shared by everything accessing a repository.
+    :param repo: The repository.
+    :type repo: git.Repo
+    :rtype: GitReader
+    """
+
+    git_dir = os.path.abspath(repo.git_dir)
+
+    with _readers_lock:
+        reader = _readers.get(git_dir)
+
+        if reader is None:
+            reader = _readers[git_dir] = GitReader(git_dir)
+
+        return reader
+
+
+def statistics():
+    """
+    :returns: The number of git processes started and of objects requested
+    through the cat-file processes, by the readers of every repository.
+    :rtype: dict[str, int]
+    """
+
+    with _readers_lock:
+        readers = list(_readers.values())
+
+    return {
+        'processes': sum(reader.process_count for reader in readers),
+        'object_requests': sum(reader.request_count for reader in readers)
+    }
+
+
+class GitReader(object):
+    """
+    Reads the objects of a repository through one git cat-file --batch and
+    one git cat-file --batch-check process, kept open for the life of the
+    reader, instead of a git process per object. Object contents, line
+    counts and tree listings are kept in bounded LRU caches. Other git
+    commands are run (or streamed) through the reader, so that every git
+    process of a run is counted in process_count, and every object
+    requested from cat-file in request_count.
+
+    Readers are safe to share between threads.
+    """
+
+    def __init__(self, git_dir, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param git_dir: The git directory of the repository.
+        :type git_dir: str
+        :param cache_size: The number of bytes of object contents to keep in memory.
+        :type cache_size: int
+        """
+
+        self.git_dir = git_dir
+        self.process_count = 0
+        self.request_count = 0
+
+        self._processes = {}
+        self._lock = threading.RLock()
+
+        self._objects = LRUCache(cache_size, size=lambda entry: len(entry[1]), name='git_objects')
+        self._line_counts = LRUCache(cache_size // 64, name='line_counts')
+        self._trees = LRUCache(TREE_CACHE_SIZE, name='tree_listings')
+
+    def _command(self, args):
+        self.process_count += 1
+
+        return ['git', *args]
+
+    def _batch(self, option):
+        """
+        :param option: --batch or --batch-check.
+        :type option: str
+        :returns: The cat-file process for the option, started the first time.
+        :rtype: subprocess.Popen
+        """
+
+        process = self._processes.get(option)
+
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(self._command(['cat-file', option]), cwd=self.git_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._processes[option] = process
+
+        return process
+
+    def _request(self, option, name):
+        """
+        Asks a cat-file process about an object.
+        :param option: --batch or --batch-check.
+        :type option: str
+        :param name: The sha or revision of the object.
+        :type name: str
+        :returns: The sha, type and size of the object, or None if it doesn't exist.
+        With --batch, the content of the object must be read next.
+        :rtype: (str, str, int) | None
+        """
+
+        self.request_count += 1
+        process = self._batch(option)
+        process.stdin.write(f'{name}\n'.encode('utf-8', errors='surrogateescape'))
+        process.stdin.flush()
+
+        header = process.stdout.readline().decode('utf-8', errors='surrogateescape').split()
+
+        # Unknown objects are reported as "<name> missing" (or "ambiguous").
+        if len(header) != 3:
+            return None
+
+        sha, object_type, size = header
+
+        return sha, object_type, int(size)
+
+    def resolve(self, name):
+        """
+        :param name: The sha or revision of an object (e.g. HEAD^{tree}).
+        :type name: str
+        :returns: The sha, type and size of the object, or None if it doesn't exist.
+        :rtype: (str, str, int) | None
+        """
+
+        with self._lock:
+            return self._request('--batch-check', name)
+
+    def read(self, name):
+        """
+        :param name: The sha or revision of an object.
+        :type name: str
+        :returns: The type and content of the object.
+        :rtype: (str, bytes)
+        """
+
+        with self._lock:
+            entry = self._objects.get(name)
+
+            if entry is not None:
+                return entry
+
+            header = self._request('--batch', name)
+
+            if header is None:
+                raise KeyError(name)
+
+            sha, object_type, size = header
+            stdout = self._batch('--batch').stdout
+            content = stdout.read(size)
+            stdout.read(1)
+
+            # Only shas are stable names for an object.
+            entry = (object_type, content)
+            self._objects.put(sha, entry)
+
+            return entry
+
+    def line_counts(self, shas):
+        """
+        Counts the lines of blobs, that is the number of newlines without
+        the final newline, plus one. An empty blob has one line.
+        :param shas: The shas of the blobs.
+        :type shas: list[str]
+        :returns: The number of lines of each blob, by sha.
+        :rtype: dict[str, int]
+        """
+
+        counts = {}
+
+        with self._lock:
+            for sha in shas:
+                count = self._line_counts.get(sha)
+
+                if count is None:
+                    _, content = self.read(sha)
+
+                    if content.endswith(b'\n'):
+                        content = content[:-1]
+
+                    count = content.count(b'\n') + 1
+                    self._line_counts.put(sha, count)
+
+                counts[sha] = count
+
+        return counts
+
+    def parents(self, rev):
+        """
+        :param rev: The revision of a commit.
+        :type rev: str
+        :returns: The shas of the parents of the commit.
+        :rtype: list[str]
+        """
+
+        _, content = self.read(rev)
+        header = content.split(b'\n\n', 1)[0].decode('utf-8', errors='surrogateescape')
+
+        return [line.split()[1] for line in header.split('\n') if line.startswith('parent ')]
+
+    def tree_entries(self, rev):
+        """
+        Lists every file of a tree, with a single git ls-tree per tree.
+        :param rev: The tree, or a commit pointing at it.
+        :type rev: str
+        :returns: The sha of each file, by path relative to the root of the tree.
+        :rtype: dict[str, str]
+        """
+
+        tree = self.resolve(f'{rev}^{{tree}}')
+
+        if tree is None:
+            raise KeyError(rev)
+
+        entries = self._trees.get(tree[0])
+
+        if entries is None:
+            entries = {}
+
+            # Entries are "<mode> <type> <sha>\t<path>", separated by NUL.
+            for entry in self.run('ls-tree', '-r', '-z', '--full-tree', tree[0]).split('\x00'):
+                if entry:
+                    info, file_path = entry.split('\t', 1)
+                    entries[file_path] = info.split()[2]
+
+            with self._lock:
+                self._trees.put(tree[0], entries)
+
+        return entries
+
+    def run(self, *args, check=True, env=None):
+        """
+        Runs a git command to completion.
+        :param args: The arguments of the git command.
+        :type args: str
+        :param check: Whether to raise an error when the command fails.
+        :type check: bool
+        :param env: Environment variables to set for the command, if any.
+        :type env: dict[str, str] | None
+        :returns: The output of the command, or its exit status when not checked.
+        Bytes that aren't valid UTF-8 (e.g. in paths) are decoded as surrogates,
+        so that they are encoded back to the same bytes.
+        :rtype: str | int
+        """
+
+        command = self._command(args)
+        process = subprocess.run(command, cwd=self.git_dir, env=dict(os.environ, **env) if env else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        if not check:
+            return process.returncode
+
+        if process.returncode:
+            raise GitCommandError(command, process.returncode, process.stderr)
+
+        return process.stdout.decode('utf-8', errors='surrogateescape')
+
+    @contextmanager
+    def stream(self, *args):
+        """
+        Runs a git command, streaming its output rather than holding it in memory.
+        :param args: The arguments of the git command.
+        :type args: str
+        :returns: The binary output of the command.
+        :rtype: io.BufferedReader
+        """
+
+        command = self._command(args)
+
+        # Errors go to a file, so that a long error can't block the output.
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, cwd=self.git_dir, stdout=subprocess.PIPE, stderr=stderr)
+
+            try:
+                yield process.stdout
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            if process.returncode:
+                stderr.seek(0)
+                raise GitCommandError(command, process.returncode, stderr.read())
+
+    def close(self):
+        """
+        Ends the cat-file processes of the reader. They are started
+        again if the reader is used afterwards.
+        """
+
+        with self._lock:
+            for process in self._processes.values():
+                process.stdin.close()
+                process.wait()
+
+            self._processes = {}
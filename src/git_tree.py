@@ -1,23 +1,110 @@
 """Functions for dealing with git file trees."""
 
-from git.objects.tree import Tree
-import itertools
-from source_file import SourceFileSnapshot
+import git_reader
+import hashlib
+import profiling
+from cache import LRUCache
 
 
-def find_lowest_common_ancestor_node(path_to_a, path_to_b):
+# Tree indexes are immutable, so they are shared by every commit
+# pointing at the same tree, and by every tree with the same paths.
+# Only the most recent trees are kept, as a tree index holds every
+# path of the tree.
+tree_index_cache = LRUCache(32, name='tree_indexes')
+
+
+class TreeIndex(object):
     """
-    Finds the lowed common ancestor node.
-    :param path_to_a: The path to node a from root.
-    :type path_to_a: list[git.objects.blob.Blob]
-    :param path_to_b: The path to node b from root.
-    :type path_to_b: list[git.object.blob.Blob]
+    Indexes the location of every file in a tree, so that distances in
+    the tree don't require searching it.
     """
 
-    for a in reversed(path_to_a):
-        for b in reversed(path_to_b):
-            if a == b:
-                return a
+    def __init__(self, file_paths):
+        """
+        Builds the index in a single pass over the files of the tree.
+        :param file_paths: The paths of all the files in the tree, relative to its root.
+        :type file_paths: list[str]
+        """
+
+        self.components = {}
+
+        # The height of each child of each directory, by directory path components.
+        child_heights = {}
+
+        for file_path in file_paths:
+            components = tuple(file_path.split('/'))
+            depth = len(components)
+            self.components[file_path] = components
+
+            for d in range(depth):
+                heights = child_heights.setdefault(components[:d], {})
+                child = components[d]
+                heights[child] = max(heights.get(child, 0), depth - d - 1)
+
+        self.diameter = 0
+
+        for heights in child_heights.values():
+            top_heights = sorted(heights.values())[-2:]
+
+            # This matches the original recursive definition: the two
+            # highest subtrees plus one, or the only subtree plus one.
+            self.diameter = max(self.diameter, sum(top_heights) + 1)
+
+    def distance(self, file_a, file_b):
+        """
+        Calculates the shortest path between two files in the tree.
+        That is the depth of each file minus 2 times the depth of their
+        lowest common ancestor, the longest common prefix of their paths.
+        :param file_a: The path of the first file, relative to the root.
+        :type file_a: str
+        :param file_b: The path of the second file, relative to the root.
+        :type file_b: str
+        :rtype: int
+        """
+
+        if file_a == file_b:
+            return 0
+
+        components_a = self.components.get(file_a) or tuple(file_a.split('/'))
+        components_b = self.components.get(file_b) or tuple(file_b.split('/'))
+
+        common = 0
+
+        for a, b in zip(components_a, components_b):
+            if a != b:
+                break
+
+            common += 1
+
+        return len(components_a) + len(components_b) - 2 * common
+
+
+def index_tree(tree):
+    """
+    Gets the index of a tree, building it the first time the tree is seen.
+    :param tree: The tree to index.
+    :type tree: git.objects.tree.Tree
+    :rtype: TreeIndex
+    """
+
+    index = tree_index_cache.get(tree.hexsha)
+
+    if index is None:
+        file_paths = list(git_reader.for_repo(tree.repo).tree_entries(tree.hexsha))
+
+        # An index only depends on the paths of the tree, so that the tree of
+        # a commit which adds or removes no file reuses the index of its parent.
+        paths_key = hashlib.sha1('\x00'.join(file_paths).encode('utf-8')).hexdigest()
+        index = tree_index_cache.get(paths_key)
+
+        if index is None:
+            with profiling.timer('tree_index.build'):
+                index = TreeIndex(file_paths)
+            tree_index_cache.put(paths_key, index)
+
+        tree_index_cache.put(tree.hexsha, index)
+
+    return index
 
 
 def calculate_distance(tree, file_a, file_b):
@@ -37,52 +124,8 @@ def calculate_distance(tree, file_a, file_b):
     :type file_b: source_file.SourceFileSnapshot
     :rtype: int
     """
-    
-    path_to_a = find_path_from_root(tree, file_a.sha)
-    path_to_b = find_path_from_root(tree, file_b.sha)
-
-    lowest_common_ancestor = find_lowest_common_ancestor_node(path_to_a, path_to_b)
-
-    path_to_lca = find_path_from_root(tree, lowest_common_ancestor.hexsha)
 
-    return calculate_path_length(path_to_a) + calculate_path_length(path_to_b) - 2 * calculate_path_length(path_to_lca)
-
-
-def find_path_from_root(tree, file_sha, path=[]):
-    """
-    Determines the path from the root to the file.
-    :param tree: The tree to look in.
-    :type tree: git.objects.tree.Tree
-    :param file_sha: The sha of the file to look for.
-    :type file_sha: str
-    :param path: The path from the root to the file.
-    :type path: list[git.objects.blob.Blob]
-    """
-
-    if tree.hexsha == file_sha:
-        return path + [tree]
-    elif type(tree) == Tree:
-        # if all are none, the node isn't in the tree.
-        # otherwise, there should be only one non-none value.
-        for st in tree:
-            potential_path = find_path_from_root(st, file_sha, path + [tree])
-            
-            if potential_path:
-                path = potential_path
-                return path
-    else:
-        return []
-
-
-def calculate_path_length(path):
-    """
-    Calculates the length of a path.
-    :param path: The path to calculate the length of.
-    :type path: list[git.objects.blob.Blob]
-    :rtype: int
-    """
-
-    return len(path) - 1
+    return index_tree(tree).distance(file_a.relative_path, file_b.relative_path)
 
 
 def calculate_diameter(tree):
@@ -95,32 +138,4 @@ def calculate_diameter(tree):
     :rtype: int
     """
 
-    if type(tree) is Tree:
-        subtree_heights = [calculate_height(st) for st in tree]
-        subtree_diameters = [calculate_diameter(st) for st in tree]
-
-        if len(subtree_heights) > 1:
-            largest_height_pair = max([h1 + h2 for h1, h2 in itertools.combinations(subtree_heights, 2)])
-        else:
-            largest_height_pair = subtree_heights[0]
-
-        return max([largest_height_pair + 1] + subtree_diameters)  
-    else:
-        return 0
-
-
-def calculate_height(tree):
-    """
-    Calculates the height of the tree.
-
-    :param tree: The tree to measure.
-    :type tree: git.objects.tree.Tree
-    :rtype: int
-    """
-
-    if type(tree) is Tree:
-        subtree_heights = [calculate_height(st) for st in tree]
-        
-        return 1 + max(subtree_heights)
-    else:
-        return 0
+    return index_tree(tree).diameter
@@ -1,67 +1,178 @@
 import change
+import numpy as np
 
-def merge(change_matrix, threshold):
+
+def _find(parents, i):
     """
-    Merges changes with values below the threshold.
+    Finds the representative of the cluster containing a change.
+    :param parents: The union-find forest of change ids.
+    :type parents: list[int]
+    :param i: The id of the change.
+    :type i: int
+    :rtype: int
+    """
+
+    while parents[i] != i:
+        # Path halving keeps the trees flat.
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+
+    return i
+
+
+def _union(parents, sizes, a, b):
+    """
+    Merges the clusters represented by a and b.
+    :param parents: The union-find forest of change ids.
+    :type parents: list[int]
+    :param sizes: The size of each cluster, by representative.
+    :type sizes: list[int]
+    :param a: The representative of the first cluster.
+    :type a: int
+    :param b: The representative of the second cluster.
+    :type b: int
+    :returns: The representative of the merged cluster.
+    :rtype: int
+    """
+
+    if sizes[a] < sizes[b]:
+        a, b = b, a
+
+    parents[b] = a
+    sizes[a] += sizes[b]
+
+    return a
+
+
+def _minimum_spanning_tree(change_matrix):
+    """
+    Finds a minimum spanning tree of the change matrix with Prim's
+    algorithm, in O(n^2) time and O(n) extra memory.
+    Missing values (NaN) are treated as infinitely far.
     :param change_matrix: Matrix of changes with convidence voter values.
-    :type change_matrix: dict[change.Change, dict[change.Change, double]]
-    :param threshold: The threshold to discriminate whether a change pair should
-    be merged or not.
-    :type threshold: double
-    :return: The updated change matrix.
-    :rtype: dict[change.Change, dict[change.Change, double]]
+    :type change_matrix: condensed_matrix.CondensedMatrix
+    :returns: The first change id, second change id and value of each edge.
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
     """
 
-    while True:
-        changes = []
+    size = len(change_matrix)
+    in_tree = np.zeros(size, dtype=bool)
+    best_values = np.full(size, np.inf)
+    best_sources = np.zeros(size, dtype=np.intp)
+
+    sources = np.empty(max(size - 1, 0), dtype=np.intp)
+    targets = np.empty(max(size - 1, 0), dtype=np.intp)
+    values = np.empty(max(size - 1, 0))
+
+    current = 0
 
-        # SELECT 2 changes with a confidence value < threshold.
-        for row in change_matrix.keys():
-            for column, confidence_vote in change_matrix[row].items():
-                if confidence_vote and confidence_vote < threshold:
-                    # collect the minimal votes.
-                    changes = [row, column]
-                    break
+    for edge in range(size - 1):
+        in_tree[current] = True
 
-            if changes:
-                break
+        row = change_matrix.row(current).astype(np.float64)
+        row = np.where(np.isnan(row), np.inf, row)
+        closer = ~in_tree & (row < best_values)
+        best_values[closer] = row[closer]
+        best_sources[closer] = current
 
-        if not changes:
-            # changes is empty and thus no acceptable changes were found.
-            break
+        current = int(np.argmin(np.where(in_tree, np.inf, best_values)))
 
-        # Find the minimal votes for all related cells.
-        minimal_votes = {}
+        sources[edge] = best_sources[current]
+        targets[edge] = current
+        values[edge] = best_values[current]
 
-        for row in change_matrix.keys():
-            for column, confidence_vote in change_matrix[row].items():
-                if row in changes or column in changes:
-                    old_vote = minimal_votes.get(column)
+    return sources, targets, values
 
-                    if not old_vote or (confidence_vote and confidence_vote < old_vote):
-                        minimal_votes[column] = confidence_vote
 
-        # Update Matrix
-        # Remove rows and columns representing removed changes.
-        change_matrix = {r: c for r,c in change_matrix.items() if r not in changes}
+def linkage(change_matrix):
+    """
+    Records the full history of merging the changes by single linkage:
+    the value between two compound changes is the minimal value between
+    any of their changes, and the closest compound changes are merged
+    first until one is left.
+
+    The history is a matrix in the format used by SciPy. Row k records
+    the k-th merge as (first cluster id, second cluster id, value, size).
+    Cluster ids below n are changes, and the cluster formed at row k gets
+    the id n + k. Rows are ordered by increasing value, so the history can
+    be cut at any threshold with cut. Pairs with a missing value are only
+    merged at an infinite value.
+
+    :param change_matrix: Matrix of changes with convidence voter values.
+    :type change_matrix: condensed_matrix.CondensedMatrix
+    :returns: The merge history.
+    :rtype: numpy.ndarray
+    """
+
+    size = len(change_matrix)
+    sources, targets, values = _minimum_spanning_tree(change_matrix)
 
-        for row in change_matrix.keys():
-            change_matrix[row] = {c: cv for c, cv in change_matrix[row].items() if c not in changes}
+    # Single linkage merges along the minimum spanning tree edges,
+    # from the lowest value to the highest.
+    order = np.argsort(values, kind='mergesort')
 
-        new_change = change.merge(changes[0], changes[1])
-        minimal_votes[new_change] = None
+    parents = list(range(size))
+    sizes = [1] * size
+    cluster_ids = list(range(size))
 
-        # Fill in the new column. The corresponding row will be all empty (triangle matrix)
-        if len(change_matrix.keys()) > 0:
-            change_matrix[new_change] = {}
+    history = np.empty((len(order), 4))
 
-            for row in change_matrix.keys():
-                change_matrix[row][new_change] = minimal_votes[row]
-                # It's as if new_change is the last row...
-                change_matrix[new_change][row] = None
-        else:
-            change_matrix[new_change] = {}
-            change_matrix[new_change][new_change] = 0
-            break
+    for k, edge in enumerate(order):
+        root_a = _find(parents, int(sources[edge]))
+        root_b = _find(parents, int(targets[edge]))
+
+        history[k] = (cluster_ids[root_a], cluster_ids[root_b], values[edge], sizes[root_a] + sizes[root_b])
+
+        root = _union(parents, sizes, root_a, root_b)
+        cluster_ids[root] = size + k
+
+    return history
+
+
+def cut(history, changes, threshold):
+    """
+    Merges changes with values below the threshold, from the merge history.
+    This takes O(n) time.
+    :param history: The merge history, see linkage.
+    :type history: numpy.ndarray
+    :param changes: The changes, in the order of their ids in the matrix.
+    :type changes: list[change.Change]
+    :param threshold: The threshold to discriminate whether a change pair should
+    be merged or not.
+    :type threshold: double
+    :return: The merged changes, ordered by their first change.
+    :rtype: list[change.Change | change.CompoundChange]
+    """
+
+    size = len(changes)
+    merges = int(np.searchsorted(history[:, 2], threshold, side='left'))
+
+    # Point every cluster merged below the threshold to the cluster it forms.
+    parents = list(range(size + merges))
+
+    for k in range(merges):
+        parents[int(history[k, 0])] = parents[int(history[k, 1])] = size + k
+
+    members = {}
+
+    for i in range(size):
+        members.setdefault(_find(parents, i), []).append(changes[i])
+
+    return [group[0] if len(group) == 1 else change.CompoundChange(*group) for group in members.values()]
+
+
+def merge(change_matrix, changes, threshold):
+    """
+    Merges changes with values below the threshold.
+    :param change_matrix: Matrix of changes with convidence voter values.
+    :type change_matrix: condensed_matrix.CondensedMatrix
+    :param changes: The changes, in the order of their ids in the matrix.
+    :type changes: list[change.Change]
+    :param threshold: The threshold to discriminate whether a change pair should
+    be merged or not.
+    :type threshold: double
+    :return: The merged changes, ordered by their first change.
+    :rtype: list[change.Change | change.CompoundChange]
+    """
 
-    return change_matrix
+    return cut(linkage(change_matrix), changes, threshold)
@@ -0,0 +1,301 @@
+"""Indexes the line ranges of the methods of Java source files."""
+
+import os
+import re
+from cache import DiskCache, LRUCache
+
+
+# Bump when the indexing changes, so that cached indexes are not reused.
+INDEX_VERSION = 2
+
+# The number of method indexes also kept in memory.
+MEMORY_CACHE_SIZE = 4096
+
+_TOKENS = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<text>""".*?""")
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\d[\w.]*)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<symbol>.)
+''', re.S | re.X)
+
+_CLASS_KEYWORDS = {'class', 'interface', 'enum', 'record'}
+
+_WORD = re.compile(r'[A-Za-z_$][\w$]*')
+
+_STATEMENT_KEYWORDS = {'if', 'for', 'while', 'switch', 'catch', 'synchronized', 'try', 'do', 'else', 'return', 'new', 'throw'}
+
+
+def _tokenize(source):
+    """
+    :param source: The Java source.
+    :type source: str
+    :returns: The value and line number of each token, without comments,
+    strings and numbers, which don't delimit declarations.
+    :rtype: collections.abc.Iterator[(str, int)]
+    """
+
+    line = 1
+
+    for match in _TOKENS.finditer(source):
+        kind = match.lastgroup
+        value = match.group()
+
+        if kind in ('word', 'symbol'):
+            yield value, line
+        elif kind == 'string':
+            yield '""', line
+
+        line += value.count('\n')
+
+
+def _strip_annotations(tokens):
+    """
+    :param tokens: The tokens of a declaration.
+    :type tokens: list[str]
+    :returns: The tokens without annotations (e.g. @Foo or @a.Bar(x = 1)).
+    :rtype: list[str]
+    """
+
+    stripped = []
+    i = 0
+
+    while i < len(tokens):
+        if tokens[i] != '@' or i + 1 == len(tokens) or tokens[i + 1] == 'interface':
+            stripped.append(tokens[i])
+            i += 1
+            continue
+
+        # Skip the qualified name, then the arguments if any.
+        i += 2
+
+        while i + 1 < len(tokens) and tokens[i] == '.':
+            i += 2
+
+        if i < len(tokens) and tokens[i] == '(':
+            depth = 0
+
+            while i < len(tokens):
+                depth += {'(': 1, ')': -1}.get(tokens[i], 0)
+                i += 1
+
+                if not depth:
+                    break
+
+    return stripped
+
+
+def _anonymous_class(tokens):
+    """
+    :param tokens: The tokens before an opening brace.
+    :type tokens: list[str]
+    :returns: Whether the brace opens the body of an anonymous class, as in new Foo<Bar>() {.
+    :rtype: bool
+    """
+
+    if not tokens or tokens[-1] != ')':
+        return False
+
+    i = len(tokens) - 1
+    depth = 0
+
+    # The opening parenthesis of the constructor arguments.
+    while i >= 0:
+        depth += {')': 1, '(': -1}.get(tokens[i], 0)
+
+        if not depth:
+            break
+
+        i -= 1
+
+    i -= 1
+
+    if i >= 0 and tokens[i] == '>':
+        depth = 0
+
+        while i >= 0:
+            depth += {'>': 1, '<': -1}.get(tokens[i], 0)
+            i -= 1
+
+            if not depth:
+                break
+
+    # The qualified type name.
+    while i >= 1 and tokens[i - 1] == '.':
+        i -= 2
+
+    return i >= 1 and tokens[i - 1] == 'new'
+
+
+def _class_keyword(tokens):
+    """
+    :param tokens: The tokens before an opening brace.
+    :type tokens: list[str]
+    :returns: The index of the keyword declaring a class, interface, enum or
+    record, or None when the brace doesn't open a type body. record is only
+    a keyword in record declarations, as in record Foo(, or record Foo<T>(.
+    :rtype: int | None
+    """
+
+    for i, token in enumerate(tokens):
+        if token not in _CLASS_KEYWORDS or (i and tokens[i - 1] == '.'):
+            continue
+
+        if token != 'record' or (i + 2 < len(tokens) and _WORD.fullmatch(tokens[i + 1]) and tokens[i + 2] in ('(', '<')):
+            return i
+
+    return None
+
+
+def _method_name(tokens):
+    """
+    :param tokens: The tokens of a declaration in a class body.
+    :type tokens: list[str]
+    :returns: The name of the declared method or constructor, or None when
+    the declaration isn't one (e.g. a field initializer or an initializer block).
+    :rtype: str | None
+    """
+
+    for i, token in enumerate(tokens):
+        if token == '=':
+            return None
+
+        if token == '(':
+            name = tokens[i - 1] if i else None
+
+            if name and (name[0].isalpha() or name[0] in '_$') and name not in _STATEMENT_KEYWORDS:
+                return name
+
+            return None
+
+    return None
+
+
+def index_source(source):
+    """
+    Finds the line ranges of the methods and constructors of a Java source.
+    Methods of nested, local and anonymous classes are included, with
+    anonymous classes named (Anon_1), (Anon_2)... in order of appearance.
+    :param source: The Java source.
+    :type source: str
+    :returns: The name of each method, in the form package.Class.method,
+    by line range in the form "start-end".
+    :rtype: dict[str, str]
+    """
+
+    methods = {}
+    package = None
+    anonymous_classes = 0
+
+    # Each open brace is a class body, a method body or another block,
+    # with the name of the class and the line of the declaration.
+    scopes = []
+    declaration = []
+    lines = []
+
+    # Enum constants come before the first semicolon of the enum body.
+    in_enum_constants = False
+
+    for token, line in _tokenize(source):
+        if token == '{':
+            tokens = _strip_annotations(declaration)
+            in_class = bool(scopes) and scopes[-1][0] == 'class'
+            keyword = _class_keyword(tokens)
+            start = lines[0] if lines else line
+
+            if keyword is not None:
+                name = tokens[keyword + 1] if keyword + 1 < len(tokens) else tokens[keyword]
+                scopes.append(('class', name, start))
+                in_enum_constants = tokens[keyword] == 'enum'
+            elif in_enum_constants and in_class and tokens and tokens[0] != '(':
+                # An enum constant with a body.
+                scopes.append(('class', tokens[0], start))
+                in_enum_constants = False
+            elif _anonymous_class(tokens):
+                anonymous_classes += 1
+                scopes.append(('class', f'(Anon_{anonymous_classes})', start))
+            elif in_class and _method_name(tokens):
+                scopes.append(('method', _method_name(tokens), start))
+            else:
+                scopes.append(('block', None, start))
+
+            declaration, lines = [], []
+        elif token == '}':
+            if scopes:
+                kind, name, start = scopes.pop()
+
+                if kind == 'method':
+                    classes = [n for k, n, _ in scopes if k == 'class']
+                    methods[f'{start}-{line}'] = '.'.join(([package] if package else []) + classes + [name])
+
+            in_enum_constants = False
+            declaration, lines = [], []
+        elif token == ';':
+            if not scopes and declaration[:1] == ['package']:
+                package = ''.join(declaration[1:])
+
+            in_enum_constants = False
+            declaration, lines = [], []
+        elif token == ',' and in_enum_constants and scopes and scopes[-1][0] == 'class':
+            declaration, lines = [], []
+        else:
+            declaration.append(token)
+            lines.append(line)
+
+    return methods
+
+
+class MethodIndexCache(LRUCache):
+    """
+    Keeps the method index of each Java blob, by sha, in an SQLite database,
+    so that a file content is only parsed once across runs. The most
+    recently used indexes are also kept in memory.
+    """
+
+    def __init__(self, directory, memory_size=MEMORY_CACHE_SIZE):
+        """
+        :param directory: The directory to keep the indexes in.
+        :type directory: str
+        :param memory_size: The number of indexes to keep in memory.
+        :type memory_size: int
+        """
+
+        super().__init__(memory_size, name='method_indexes', disk=DiskCache(os.path.join(directory, f'v{INDEX_VERSION}.sqlite')))
+
+
+def index_snapshots(reader, snapshots, method_index_cache=None):
+    """
+    Indexes the methods of the Java files of snapshots, reading each file
+    at the commit of its snapshot. The deleted and added lines of a file
+    have snapshots of different blobs, so the methods are indexed by blob.
+    Only the blobs not cached are parsed.
+    :param reader: The reader of the repository.
+    :type reader: git_reader.GitReader
+    :param snapshots: The snapshots of the files to index.
+    :type snapshots: list[source_file.SourceFileSnapshot]
+    :param method_index_cache: The cache of the indexes of each blob, if any.
+    :type method_index_cache: MethodIndexCache | None
+    :returns: An index of the methods of each blob, by sha, see method_lookup.MethodLookup.
+    :rtype: dict[str, dict[str, str]]
+    """
+
+    method_index = {}
+
+    for snapshot in snapshots:
+        if not snapshot.relative_path.endswith('.java') or snapshot.sha in method_index:
+            continue
+
+        methods = method_index_cache.get(snapshot.sha) if method_index_cache is not None else None
+
+        if methods is None:
+            _, content = reader.read(snapshot.sha)
+            methods = index_source(content.decode('utf-8', errors='replace'))
+
+            if method_index_cache is not None:
+                method_index_cache.put(snapshot.sha, methods)
+
+        method_index[snapshot.sha] = methods
+
+    return method_index
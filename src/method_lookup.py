@@ -0,0 +1,89 @@
+"""Finds the method enclosing a line of a source file."""
+
+from bisect import bisect_right
+
+
+class MethodLookup(object):
+    """
+    Indexes the line ranges of the methods of each blob as sorted
+    integer arrays, so that finding the method enclosing a line is a
+    binary search rather than a scan of the file's methods.
+    """
+
+    def __init__(self, method_index):
+        """
+        :param method_index: An index of all the methods and line numbers they occupy,
+        mapping the sha of each file blob to ranges in the form "start-end" mapped to method names.
+        :type method_index: dict[str, dict[str, str]]
+        """
+
+        self._blobs = {}
+
+        for sha, methods in method_index.items():
+            ranges = []
+
+            for line_range, method_name in methods.items():
+                start, end = [int(l) for l in line_range.split('-')]
+                ranges.append((start, -end, method_name))
+
+            # Sorting by start, then by decreasing end, puts each method
+            # before the methods nested in it (e.g. in anonymous classes).
+            ranges.sort()
+
+            starts = [start for start, _, _ in ranges]
+            ends = [-end for _, end, _ in ranges]
+            names = [name for _, _, name in ranges]
+
+            self._blobs[sha] = (starts, ends, names, _enclosing_ranges(starts, ends))
+
+    def find(self, sha, line_number):
+        """
+        Finds the innermost method enclosing a line.
+        :param sha: The blob of the file containing the line, see source_file.SourceFileSnapshot.sha.
+        :type sha: str
+        :param line_number: The line number to look up.
+        :type line_number: int
+        :returns: The name of the enclosing method, or None if the line
+        isn't in a method or the file is not likely code.
+        :rtype: str | None
+        """
+
+        ranges = self._blobs.get(sha)
+
+        if ranges is None:
+            return None
+
+        starts, ends, names, parents = ranges
+
+        # The last method starting at or before the line encloses it,
+        # or else one of the methods enclosing that method does.
+        i = bisect_right(starts, line_number) - 1
+
+        while i >= 0 and ends[i] < line_number:
+            i = parents[i]
+
+        return names[i] if i >= 0 else None
+
+
+def _enclosing_ranges(starts, ends):
+    """
+    Finds the range directly enclosing each range.
+    :param starts: The start of each range, sorted.
+    :type starts: list[int]
+    :param ends: The end of each range.
+    :type ends: list[int]
+    :returns: The position of the range enclosing each range, or -1.
+    :rtype: list[int]
+    """
+
+    parents = []
+    open_ranges = []
+
+    for i, start in enumerate(starts):
+        while open_ranges and ends[open_ranges[-1]] < start:
+            open_ranges.pop()
+
+        parents.append(open_ranges[-1] if open_ranges else -1)
+        open_ranges.append(i)
+
+    return parents
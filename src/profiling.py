@@ -0,0 +1,158 @@
+"""Measures where the time and memory of a run go."""
+
+import cache
+import git_reader
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# The profile of the run, or None when the run isn't profiled, see enable.
+_profile = None
+
+_no_timer = nullcontext()
+
+
+class Profile(object):
+    """
+    Collects the timers and counters of a run. A timer adds up the wall
+    time and the CPU time of the thread it runs in, over all its calls.
+    Profiles are safe to share between threads.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timers = {}
+        self.counters = {}
+
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times a block of code.
+        :param name: The name of the timer.
+        :type name: str
+        """
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+
+            with self._lock:
+                timer = self.timers.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+                timer['calls'] += 1
+                timer['wall'] += wall
+                timer['cpu'] += cpu
+
+    def count(self, name, n=1):
+        """
+        :param name: The name of the counter.
+        :type name: str
+        :param n: The number to add to the counter.
+        :type n: int
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        :returns: The timers and counters of the run, with the git processes
+        and object requests, the statistics of the caches, the CPU time and
+        the peak memory of the process and of its finished child processes
+        (git, Understand and the workers). Platforms without resource usage
+        (Windows) report no peak memory, nor CPU time of the children.
+        :rtype: dict
+        """
+
+        try:
+            import resource
+        except ImportError:
+            cpu = {'process': time.process_time(), 'children': None}
+            peak_memory = {'process': None, 'children': None}
+        else:
+            process = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            # The peak resident memory is in bytes on macOS, and in kilobytes elsewhere.
+            unit = 1 if sys.platform == 'darwin' else 1024
+
+            cpu = {'process': process.ru_utime + process.ru_stime, 'children': children.ru_utime + children.ru_stime}
+            peak_memory = {'process': process.ru_maxrss * unit, 'children': children.ru_maxrss * unit}
+
+        caches = cache.statistics()
+
+        for stats in caches.values():
+            lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else None
+
+        with self._lock:
+            return {
+                'wall': time.perf_counter() - self.start,
+                'cpu': cpu,
+                'peak_memory': peak_memory,
+                'timers': {name: dict(timer) for name, timer in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'git': git_reader.statistics(),
+                'caches': caches
+            }
+
+
+def enable():
+    """
+    Starts profiling the run.
+    :returns: The profile of the run.
+    :rtype: Profile
+    """
+
+    global _profile
+
+    _profile = Profile()
+
+    return _profile
+
+
+def timer(name):
+    """
+    Times a block of code, when the run is profiled.
+    :param name: The name of the timer, e.g. stage.changes.
+    :type name: str
+    """
+
+    if _profile is None:
+        return _no_timer
+
+    return _profile.timer(name)
+
+
+def count(name, n=1):
+    """
+    Adds to a counter, when the run is profiled.
+    :param name: The name of the counter.
+    :type name: str
+    :param n: The number to add to the counter.
+    :type n: int
+    """
+
+    if _profile is not None:
+        _profile.count(name, n)
+
+
+def write_report(path):
+    """
+    Writes the report of the profile of the run as JSON.
+    :param path: The file to write the report to.
+    :type path: str
+    """
+
+    with open(path, 'w') as f:
+        json.dump(_profile.report(), f, indent=2)
+        f.write('\n')
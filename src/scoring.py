@@ -0,0 +1,337 @@
+"""Computes the confidence voter scores of all change pairs at once."""
+
+import numpy as np
+import profiling
+import voters
+from concurrent.futures import ProcessPoolExecutor
+from condensed_matrix import CondensedMatrix
+
+
+# The number of pairs scored at once when pruning, see PairScorer.score_pruned_pairs.
+PRUNE_BLOCK_PAIRS = 1 << 20
+
+
+def _index_files(changes):
+    """
+    Assigns an integer id to each distinct file touched by the changes.
+    :param changes: The changes to index.
+    :type changes: list[change.Change]
+    :returns: The file id of each change and one snapshot per file id.
+    :rtype: (numpy.ndarray, list[source_file.SourceFileSnapshot])
+    """
+
+    file_ids = {}
+    snapshots = []
+    change_file_ids = np.empty(len(changes), dtype=np.intp)
+
+    for i, change in enumerate(changes):
+        snapshot = change.source_file_snapshot
+        file_id = file_ids.get(snapshot.file_path)
+
+        if file_id is None:
+            file_id = len(snapshots)
+            file_ids[snapshot.file_path] = file_id
+            snapshots.append(snapshot)
+
+        change_file_ids[i] = file_id
+
+    return change_file_ids, snapshots
+
+
+def _add_votes(total, count, votes):
+    """
+    Adds the valid votes (between 0 and 1) of a voter to the pair totals.
+    :param total: The sum of the valid votes of each pair so far.
+    :type total: numpy.ndarray
+    :param count: The number of valid votes of each pair so far.
+    :type count: numpy.ndarray
+    :param votes: The votes of the voter for each pair.
+    :type votes: numpy.ndarray
+    """
+
+    valid = (votes >= 0) & (votes <= 1)
+    total += np.where(valid, votes, 0)
+    count += valid
+
+
+class PairScorer(object):
+    """
+    Scores change pairs with a set of voters, see voters.Voter.
+
+    With a threshold, the voters are evaluated from the cheapest to the
+    most expensive, and a pair stops being evaluated once the remaining
+    voters can't move its score across the threshold. The expensive
+    voters then only calculate what the pairs evaluated by them need.
+    """
+
+    def __init__(self, voter_classes, resources, changes, threshold=None):
+        """
+        :param voter_classes: The voters to score the pairs with.
+        :type voter_classes: list[type]
+        :param resources: The resources the voters are set up from, by name
+        (see voters.Voter).
+        :type resources: dict[str, object]
+        :param changes: The changes to score.
+        :type changes: list[change.Change]
+        :param threshold: The only threshold the changes will be merged at, to
+        prune the evaluation of the voters with. The scores are then only exact
+        for the pairs evaluated with every voter, but fall on the same side of
+        the threshold. None evaluates every voter of every pair.
+        :type threshold: float | None
+        """
+
+        self.size = len(changes)
+        self.threshold = threshold
+
+        file_ids, snapshots = _index_files(changes)
+        lazy = threshold is not None
+
+        self.voters = []
+
+        for voter_class in sorted(voter_classes, key=lambda voter_class: voter_class.cost):
+            with profiling.timer(f'voter.{voter_class.name}.setup'):
+                self.voters.append(voter_class(resources, changes, file_ids, snapshots, lazy))
+
+    def _settle(self, scores, total, count, remaining, pairs):
+        """
+        Bounds the score of pairs, given that each remaining voter is
+        at least 0 and at most 1, and keeps a bound as the score of the
+        pairs it puts on one side of the threshold.
+        :param scores: The scores to write the settled pairs to.
+        :type scores: numpy.ndarray
+        :param total: The sum of the valid votes of each pair so far.
+        :type total: numpy.ndarray
+        :param count: The number of valid votes of each pair so far.
+        :type count: numpy.ndarray
+        :param remaining: The number of voters left that may be valid for each pair.
+        :type remaining: numpy.ndarray
+        :param pairs: The positions of the pairs to settle.
+        :type pairs: numpy.ndarray
+        :returns: The positions of the pairs that are still unsettled.
+        :rtype: numpy.ndarray
+        """
+
+        voters = count[pairs] + remaining[pairs]
+
+        # Compared as they are stored, so that rounding can't cross the threshold.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower = (total[pairs] / voters).astype(CondensedMatrix.dtype)
+            upper = ((total[pairs] + remaining[pairs]) / voters).astype(CondensedMatrix.dtype)
+
+        merged = upper < self.threshold
+        apart = lower >= self.threshold
+
+        scores[pairs[merged]] = upper[merged]
+        scores[pairs[apart]] = lower[apart]
+
+        return pairs[~(merged | apart)]
+
+    def score_pruned_pairs(self, i, j):
+        """
+        Calculates the scores of change pairs, evaluating the expensive
+        voters only for the pairs the cheaper ones leave undecided.
+        :param i: The ids of the first change of each pair.
+        :type i: numpy.ndarray
+        :param j: The ids of the second change of each pair.
+        :type j: numpy.ndarray
+        :returns: The score of each pair, on the same side of the threshold as the exact score.
+        :rtype: numpy.ndarray
+        """
+
+        scores = np.full(len(i), np.nan)
+        total = np.zeros(len(i))
+        count = np.zeros(len(i))
+        remaining = np.zeros(len(i))
+
+        for voter in self.voters:
+            remaining += voter.may_vote(i, j)
+
+        pairs = np.arange(len(i))
+
+        for voter in self.voters:
+            pair_i, pair_j = i[pairs], j[pairs]
+            pair_total, pair_count = total[pairs], count[pairs]
+
+            with profiling.timer(f'voter.{voter.name}'):
+                _add_votes(pair_total, pair_count, voter.votes(pair_i, pair_j))
+
+            profiling.count(f'pairs.{voter.name}', len(pairs))
+
+            total[pairs], count[pairs] = pair_total, pair_count
+            remaining[pairs] -= voter.may_vote(pair_i, pair_j)
+
+            pairs = self._settle(scores, total, count, remaining, pairs)
+
+        # The pairs left without any valid vote keep a NaN score.
+        return scores
+
+    def score_row(self, i):
+        """
+        Calculates the score of the change with every change after it,
+        that is the mean of the confidence voters with a valid value
+        (between 0 and 1). 0 means changes are close, 1 means they are far.
+        :param i: The id of the change.
+        :type i: int
+        :returns: The scores of the pairs (i, j) for all j > i.
+        :rtype: numpy.ndarray
+        """
+
+        others = np.arange(i + 1, self.size)
+        row = np.full(len(others), i)
+
+        total = np.zeros(len(others))
+        count = np.zeros(len(others))
+
+        for voter in self.voters:
+            with profiling.timer(f'voter.{voter.name}'):
+                _add_votes(total, count, voter.votes(row, others))
+
+            profiling.count(f'pairs.{voter.name}', len(others))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / count
+
+    def score_rows(self, change_matrix, start, stop):
+        """
+        Scores the rows [start, stop) of the upper triangle of the change matrix.
+        :param change_matrix: The matrix to write the scores to.
+        :type change_matrix: condensed_matrix.CondensedMatrix
+        :param start: The first row to score.
+        :type start: int
+        :param stop: The row to stop at.
+        :type stop: int
+        """
+
+        if self.threshold is None:
+            for i in range(start, stop):
+                change_matrix.values[change_matrix.row_slice(i)] = self.score_row(i)
+
+            return
+
+        # Pruned pairs are scored a few rows at a time, so that the
+        # expensive voters are evaluated for many pairs at once.
+        row = start
+
+        while row < stop:
+            first = change_matrix.row_slice(row).start
+            end = row + 1
+
+            while end < stop and change_matrix.row_slice(end).stop - first <= PRUNE_BLOCK_PAIRS:
+                end += 1
+
+            last = change_matrix.row_slice(end - 1).stop
+            i, j = change_matrix.pairs(np.arange(first, last))
+            change_matrix.values[first:last] = self.score_pruned_pairs(i, j)
+            row = end
+
+
+def row_blocks(size, count):
+    """
+    Splits the rows of the upper triangle of a matrix into contiguous
+    blocks holding about the same number of pairs.
+    :param size: The number of changes.
+    :type size: int
+    :param count: The number of blocks to aim for.
+    :type count: int
+    :returns: The start and stop row of each block.
+    :rtype: list[(int, int)]
+    """
+
+    # The number of pairs before each row, and after the last one.
+    rows = np.arange(size + 1, dtype=np.int64)
+    pairs_before = rows * (2 * size - rows - 1) // 2
+
+    targets = np.linspace(0, pairs_before[-1], count + 1)[1:-1]
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(pairs_before, targets), [size]]))
+
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# The scorer and matrix of a worker process, see _init_worker.
+_worker_scorer = None
+_worker_matrix = None
+
+
+def _init_worker(scorer, size, path, shared_name):
+    """
+    Receives the read-only inputs of a worker process once, and opens
+    the change matrix the worker writes to.
+    """
+
+    global _worker_scorer, _worker_matrix
+
+    _worker_scorer = scorer
+    _worker_matrix = CondensedMatrix.attach(size, path, shared_name)
+
+
+def _score_block(block):
+    """
+    Scores a block of rows in a worker process, straight into the change matrix.
+    :param block: The start and stop row of the block.
+    :type block: (int, int)
+    """
+
+    _worker_scorer.score_rows(_worker_matrix, *block)
+    _worker_matrix.flush()
+
+
+def score_changes(resources, changes, voter_names=voters.DEFAULT_VOTERS, path=None, jobs=1, threshold=None):
+    """
+    Calculates the score of every change pair.
+    :param resources: The resources the voters are set up from, by name
+    (see voters.Voter).
+    :type resources: dict[str, object]
+    :param changes: The changes to score.
+    :type changes: list[change.Change]
+    :param voter_names: The names of the voters to score the pairs with.
+    :type voter_names: list[str]
+    :param path: An optional file to memory-map the change matrix to.
+    :type path: str | None
+    :param jobs: The number of processes to score the pairs with.
+    :type jobs: int
+    :param threshold: The only threshold the changes will be merged at, to prune
+    the evaluation of the voters with (see PairScorer), or None.
+    :type threshold: float | None
+    :returns: The change matrix, indexed by the position of the changes.
+    :rtype: condensed_matrix.CondensedMatrix
+    """
+
+    scorer = PairScorer(voters.select(voter_names), resources, changes, threshold)
+
+    return score_pairs(scorer, len(changes), path, jobs)
+
+
+def score_pairs(scorer, size, path=None, jobs=1):
+    """
+    Scores every change pair with a scorer.
+    :param scorer: The scorer of the change pairs.
+    :type scorer: PairScorer
+    :param size: The number of changes.
+    :type size: int
+    :param path: An optional file to memory-map the change matrix to.
+    :type path: str | None
+    :param jobs: The number of processes to score the pairs with.
+    :type jobs: int
+    :returns: The change matrix, indexed by the position of the changes.
+    :rtype: condensed_matrix.CondensedMatrix
+    """
+
+    profiling.count('pairs', size * (size - 1) // 2)
+
+    if jobs > 1:
+        # Workers write to a memory-mapped file or to shared memory. More
+        # blocks than workers keep them all busy until the end.
+        change_matrix = CondensedMatrix(size, path, shared=not path)
+
+        try:
+            with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(scorer, size, path, change_matrix.shared_name)) as executor:
+                list(executor.map(_score_block, row_blocks(size, jobs * 4)))
+        finally:
+            change_matrix.unshare()
+    else:
+        change_matrix = CondensedMatrix(size, path)
+        scorer.score_rows(change_matrix, 0, size)
+
+    change_matrix.flush()
+
+    return change_matrix
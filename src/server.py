@@ -0,0 +1,330 @@
+"""Serves untangle requests for a repository kept open between requests."""
+
+import argparse
+import json
+import os
+import socketserver
+import stat
+import threading
+import untangler
+import voters
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class UntangleService(object):
+    """
+    Untangles the commits of one repository for every request, with one
+    untangler, so that the repository, its indexes and its recent call
+    graphs stay in memory. The co-change index is brought up to date
+    with the new commits before each commit is untangled.
+
+    The untangler shares GitPython objects between its stages, so commits
+    are untangled one at a time.
+    """
+
+    def __init__(self, repo_untangler, thresholds=(0.4,)):
+        """
+        :param repo_untangler: The untangler of the repository.
+        :type repo_untangler: untangler.Untangler
+        :param thresholds: The thresholds to merge the changes at, unless a request gives others.
+        :type thresholds: list[float]
+        """
+
+        self.untangler = repo_untangler
+        self.thresholds = thresholds
+        self.request_count = 0
+
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Opens the indexes that don't depend on the untangled commit, before the first request.
+        """
+
+        if 'co_change_index' in self.untangler.required:
+            self.untangler.co_change_index()
+
+    def refresh(self):
+        """
+        :returns: Whether the indexes changed, see untangler.Untangler.refresh.
+        :rtype: bool
+        """
+
+        with self._lock:
+            return self.untangler.refresh()
+
+    def untangle(self, commit_hash, thresholds=None, prune=False):
+        """
+        :param commit_hash: The commit hash of the commit to untangle.
+        :type commit_hash: str
+        :param thresholds: The thresholds to merge the changes at, or None for the default ones.
+        :type thresholds: list[float] | None
+        :param prune: Whether to prune the voters, see untangler.Untangler.untangle.
+        :type prune: bool
+        :returns: The HTTP status and the JSON object of the commit, see
+        untangler.untangle_record. The status is 422 when the commit can't be
+        untangled, and 500 when the indexes can't be brought up to date.
+        :rtype: (int, str)
+        """
+
+        with self._lock:
+            self.request_count += 1
+
+            try:
+                self.untangler.refresh()
+            except Exception as e:
+                return 500, json.dumps({'commit': commit_hash, 'error': f'{type(e).__name__}: {e}'})
+
+            record = untangler.untangle_record(self.untangler, commit_hash, thresholds or self.thresholds, prune)
+
+        return (422 if 'error' in json.loads(record) else 200), record
+
+    def status(self):
+        """
+        :returns: The repository, the newest indexed commit and the work done so far.
+        :rtype: dict
+        """
+
+        required = self.untangler.required
+
+        return {
+            'repo': os.path.abspath(self.untangler.repo_path),
+            'voters': list(self.untangler.voter_names),
+            'co_change_head': self.untangler.co_change_index().head if 'co_change_index' in required else None,
+            'requests': self.request_count,
+            'git_processes': self.untangler.reader.process_count
+        }
+
+
+class UntangleRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of the API, in JSON:
+
+    GET or POST /untangle?commit=<hash>[&thresholds=0.4,0.6][&prune=1]
+        Untangles a commit, see untangler.untangle_record. Commits that
+        can't be untangled are answered with their error, and status 422.
+        Indexes that can't be brought up to date are answered with status 500.
+    POST /refresh
+        Brings the indexes up to date with the new commits, or answers
+        their error with status 500.
+    GET /status
+        Describes the repository and its indexes.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == '/untangle':
+            self._untangle(parse_qs(url.query))
+        elif url.path == '/status':
+            self._send(200, json.dumps(self.server.service.status()))
+        else:
+            self._send(404, json.dumps({'error': f'Unknown path {url.path}'}))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path == '/untangle':
+            self._untangle(parse_qs(url.query))
+        elif url.path == '/refresh':
+            self._refresh()
+        else:
+            self._send(404, json.dumps({'error': f'Unknown path {url.path}'}))
+
+    def _untangle(self, query):
+        """
+        :param query: The values of each parameter of the request.
+        :type query: dict[str, list[str]]
+        """
+
+        commit_hash = query.get('commit', [None])[0]
+        prune = query.get('prune', ['0'])[0] not in ('0', 'false', '')
+
+        try:
+            thresholds = [float(t) for t in query['thresholds'][0].split(',')] if 'thresholds' in query else None
+        except ValueError:
+            self._send(400, json.dumps({'error': 'Thresholds must be comma-separated numbers.'}))
+            return
+
+        if not commit_hash:
+            self._send(400, json.dumps({'error': 'Give the commit to untangle.'}))
+        elif prune and len(thresholds or self.server.service.thresholds) != 1:
+            self._send(400, json.dumps({'error': 'Pruning requires a single threshold.'}))
+        else:
+            self._send(*self.server.service.untangle(commit_hash, thresholds, prune))
+
+    def _refresh(self):
+        try:
+            refreshed = self.server.service.refresh()
+        except Exception as e:
+            self._send(500, json.dumps({'error': f'{type(e).__name__}: {e}'}))
+        else:
+            self._send(200, json.dumps({'refreshed': refreshed}))
+
+    def _send(self, status, body):
+        """
+        :param status: The HTTP status of the response.
+        :type status: int
+        :param body: The JSON body of the response.
+        :type body: str
+        """
+
+        content = f'{body}\n'.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves HTTP on a Unix socket, which only local users can connect to.
+    """
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+
+        # Unix sockets have no client address, which the request logs expect.
+        return request, ('local', 0)
+
+
+def create_server(service, socket_path=None, host='127.0.0.1', port=8000):
+    """
+    :param service: The service answering the requests.
+    :type service: UntangleService
+    :param socket_path: The Unix socket to listen on, instead of a TCP port.
+    :type socket_path: str | None
+    :param host: The address to listen on.
+    :type host: str
+    :param port: The TCP port to listen on. 0 picks a free port.
+    :type port: int
+    :returns: The server, ready to serve_forever.
+    :rtype: socketserver.BaseServer
+    """
+
+    if socket_path:
+        # A socket left behind by a server that didn't shut down.
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+
+        server = UnixHTTPServer(socket_path, UntangleRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), UntangleRequestHandler)
+
+    server.service = service
+
+    return server
+
+
+def main(repo_path, thresholds=(0.4,), socket_path=None, host='127.0.0.1', port=8000, since=None, max_count=None, cache_dir=untangler.DEFAULT_CACHE_DIR, voter_names=voters.DEFAULT_VOTERS):
+    """
+    :param repo_path: The path to the repository to mine.
+    :type repo_path: str
+    :param thresholds: The default thresholds to merge the changes at.
+    :type thresholds: list[float]
+    :param socket_path: The Unix socket to listen on, instead of a TCP port.
+    :type socket_path: str | None
+    :param host: The address to listen on.
+    :type host: str
+    :param port: The TCP port to listen on.
+    :type port: int
+    :param since: Only mine the history more recent than this date.
+    :type since: str | None
+    :param max_count: Only mine this many of the most recent commits.
+    :type max_count: int | None
+    :param cache_dir: The directory to cache indexes in across runs.
+    :type cache_dir: str
+    :param voter_names: The names of the confidence voters to score the change pairs with.
+    :type voter_names: list[str]
+    """
+
+    service = UntangleService(untangler.Untangler(repo_path, since, max_count, cache_dir, voter_names), thresholds)
+    service.warm()
+
+    server = create_server(service, socket_path, host, port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.untangler.close()
+
+        if socket_path:
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serves untangle requests for a Git repository, keeping its indexes in memory.'
+    )
+
+    parser.add_argument(
+        'repo_path',
+        help='The path to the repository to mine.'
+    )
+
+    parser.add_argument(
+        '--socket',
+        help='Listen on this Unix socket instead of a TCP port.'
+    )
+
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='The address to listen on. Defaults to 127.0.0.1.'
+    )
+
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help='The TCP port to listen on. Defaults to 8000.'
+    )
+
+    parser.add_argument(
+        '--thresholds',
+        type=float,
+        nargs='+',
+        default=[0.4],
+        help='The thresholds to merge the changes at, unless a request gives others. Defaults to 0.4.'
+    )
+
+    parser.add_argument(
+        '--since',
+        help='Only mine the history more recent than this date for co-changes.'
+    )
+
+    parser.add_argument(
+        '--max-count',
+        type=int,
+        help='Only mine this many of the most recent commits for co-changes.'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        default=untangler.DEFAULT_CACHE_DIR,
+        help=f'The directory to cache indexes in across runs. Defaults to {untangler.DEFAULT_CACHE_DIR}.'
+    )
+
+    parser.add_argument(
+        '--voters',
+        type=lambda names: names.split(','),
+        default=list(voters.DEFAULT_VOTERS),
+        help=f'The comma-separated confidence voters to score the change pairs with, among {",".join(voters.VOTERS)}. Defaults to all of them.'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        voters.select(args.voters)
+    except ValueError as e:
+        parser.error(str(e))
+
+    main(args.repo_path, args.thresholds, args.socket, args.host, args.port, args.since, args.max_count, args.cache_dir, args.voters)
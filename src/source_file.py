@@ -1,4 +1,6 @@
 import os
+import git_reader
+from cache import LRUCache
 
 
 class SourceFileSnapshot(object):
@@ -6,12 +8,12 @@ class SourceFileSnapshot(object):
 	Represents a source file at a given point in history.
 	"""
 
-	# Calculating the file length is expensive. We don't want to
-	# repeat it over and over for the same files.
-	file_length_cache = {}
+	# The snapshot of each file at each recent commit, so that all
+	# the changes of a file share one snapshot. See snapshot_files.
+	snapshot_cache = LRUCache(1 << 16, name='snapshots')
 
 
-	def __init__(self, file_path, repo, commit, repo_path):
+	def __init__(self, file_path, repo, commit, repo_path, sha=None, line_length=None):
 		"""
 		:param file_path: The path to the source file.
 		:type file_path: str
@@ -21,26 +23,81 @@ class SourceFileSnapshot(object):
 		:type commit: git.objects.commit.Commit
 		:param repo_path: The path to the root of the repo.
 		:type repo_path: str
+		:param sha: The blob of the file at the commit, if already known.
+		:type sha: str | None
+		:param line_length: The length of the file in lines, if already known.
+		:type line_length: int | None
 		"""
 
 		self._repo = repo
 		self._commit = commit
 
+		reader = git_reader.for_repo(repo)
+
 		self.file_path = os.path.abspath(os.path.join(repo_path, file_path))
-		self.sha = commit.tree[file_path].hexsha
+		self.relative_path = file_path
+		self.sha = sha or reader.tree_entries(commit.hexsha)[file_path]
 
 		# This gets the length of the file at point in time of the commit.
-		file_length_key = f'{commit}:{file_path}'
-		length = self.file_length_cache.get(file_length_key)
-
-		if not length:
-			length = len(repo.git.show(file_length_key).split('\n'))
-			self.file_length_cache[file_length_key] = length
+		# The reader keeps the lengths of the files it has already read.
+		if line_length is None:
+			line_length = reader.line_counts([self.sha])[self.sha]
 
-		self.line_length = length
+		self.line_length = line_length
 
 	def __str__(self):
 		return f'{self.file_path}'
 
 	def __repr__(self):
 		return str(self)
+
+
+def snapshot_files(repo, commit, repo_path, file_paths):
+	"""
+	Gets the snapshots of files at a commit, creating the ones not seen
+	before from a single listing of the tree of the commit and a single
+	git process reading the blobs, rather than git processes per file.
+	:param repo: The repository the files belong to.
+	:type repo: git.Repo
+	:param commit: The commit of the snapshots.
+	:type commit: git.objects.commit.Commit
+	:param repo_path: The path to the root of the repo.
+	:type repo_path: str
+	:param file_paths: The paths of the files, relative to the root of the repo.
+	They must be in the tree of the commit (e.g. the paths of the deleted lines
+	are in the tree of the parent).
+	:type file_paths: list[str]
+	:returns: The snapshot of each file, by path.
+	:rtype: dict[str, SourceFileSnapshot]
+	"""
+
+	cache = SourceFileSnapshot.snapshot_cache
+	snapshots = {}
+
+	for file_path in set(file_paths):
+		snapshot = cache.get((commit.hexsha, file_path))
+
+		if snapshot is not None:
+			snapshots[file_path] = snapshot
+
+	missing = sorted(set(p for p in file_paths if p not in snapshots))
+
+	if not missing:
+		return snapshots
+
+	reader = git_reader.for_repo(repo)
+	entries = reader.tree_entries(commit.hexsha)
+
+	for file_path in missing:
+		if file_path not in entries:
+			raise KeyError(f'{file_path} is not in the tree of commit {commit.hexsha}')
+
+	lengths = reader.line_counts([entries[p] for p in missing])
+
+	for file_path in missing:
+		sha = entries[file_path]
+		snapshot = SourceFileSnapshot(file_path, repo, commit, repo_path, sha, lengths[sha])
+		cache.put((commit.hexsha, file_path), snapshot)
+		snapshots[file_path] = snapshot
+
+	return snapshots
@@ -2,67 +2,353 @@
 
 from git import Repo
 import commit_splitter
-import confidence_voters
-import itertools
+import json
+import sys
+import threading
+import scoring
+import voters
+import git_reader
 import argparse
 import call_graph
 import os
 import merger
+import profiling
+from co_change_index import CoChangeIndex
+from method_lookup import MethodLookup
+from method_indexer import MethodIndexCache, index_snapshots
+from change import CompoundChange
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
 
 
-def main(repo_path, commit_hash):
+# Where the indexes that outlive a run are kept.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'untangler')
+
+
+def run_stages(stages):
+    """
+    Runs independent stages concurrently, and waits for all of them.
+    The stages mostly wait on external tools and git, so threads are enough.
+    Each stage is timed as stage.<name> when the run is profiled.
+    :param stages: The function running each stage, by name.
+    :type stages: dict[str, () -> object]
+    :returns: The result of each stage, by name.
+    :rtype: dict[str, object]
+    """
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = {name: executor.submit(_timed_stage, name, stage) for name, stage in stages.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _timed_stage(name, stage):
+    with profiling.timer(f'stage.{name}'):
+        return stage()
+
+
+class Untangler(object):
+    """
+    Untangles the commits of a repository. The repository, its git reader,
+    its co-change index and the caches of its call graphs and method indexes
+    are kept across commits, so that they are only prepared once.
+    """
+
+    def __init__(self, repo_path, since=None, max_count=None, cache_dir=DEFAULT_CACHE_DIR, voter_names=voters.DEFAULT_VOTERS):
+        """
+        :param repo_path: The path to the repository to mine.
+        :type repo_path: str
+        :param since: Only mine the history more recent than this date.
+        :type since: str | None
+        :param max_count: Only mine this many of the most recent commits.
+        :type max_count: int | None
+        :param cache_dir: The directory to cache indexes in across runs.
+        :type cache_dir: str
+        :param voter_names: The names of the confidence voters to score the change pairs with.
+        :type voter_names: list[str]
+        """
+
+        self.repo_path = repo_path
+        self.repo = Repo(repo_path)
+        self.reader = git_reader.for_repo(self.repo)
+
+        self.since = since
+        self.max_count = max_count
+        self.cache_dir = cache_dir
+        self.voter_names = voter_names
+
+        # Only the resources of the selected voters are prepared.
+        self.required = voters.requirements(voter_names)
+
+        self.call_graph_cache = call_graph.CallGraphCache(os.path.join(cache_dir, 'call_graphs'))
+        self.method_index_cache = MethodIndexCache(os.path.join(cache_dir, 'method_index'))
+
+        self._co_change_index = None
+        self._co_change_lock = threading.Lock()
+
+    def co_change_index(self):
+        """
+        :returns: The co-change index of the repository, opened the first time it is needed.
+        :rtype: co_change_index.CoChangeIndex
+        """
+
+        with self._co_change_lock:
+            if self._co_change_index is None:
+                self._co_change_index = CoChangeIndex.open(self.repo, self.cache_dir, since=self.since, max_count=self.max_count)
+
+            return self._co_change_index
+
+    def refresh(self):
+        """
+        Brings the co-change index up to date with the commits made since
+        it was opened, indexing only the new commits. Only a lookup of HEAD
+        when no commit was made.
+        :returns: Whether the index changed.
+        :rtype: bool
+        """
+
+        with self._co_change_lock:
+            if self._co_change_index is None:
+                return False
+
+            head = self.reader.resolve('HEAD')
+
+            if head is None or head[0] == self._co_change_index.head:
+                return False
+
+            self._co_change_index = CoChangeIndex.open(self.repo, self.cache_dir, since=self.since, max_count=self.max_count)
+
+            return True
+
+    def close(self):
+        """
+        Ends the git processes reading the repository: the cat-file processes
+        of its reader (see git_reader.GitReader.close) and of GitPython.
+        """
+
+        self.reader.close()
+        self.repo.git.clear_cache()
+
+    def untangle(self, commit_hash, thresholds=(0.4,), matrix_path=None, jobs=1, prune=False):
+        """
+        :param commit_hash: The commit hash of the commit to untangle.
+        :type commit_hash: str
+        :param thresholds: The thresholds to merge the changes at.
+        :type thresholds: list[float]
+        :param matrix_path: An optional file to memory-map the change matrix to.
+        :type matrix_path: str | None
+        :param jobs: The number of processes to score the change pairs with.
+        :type jobs: int
+        :param prune: Whether to skip the voters that can't change which side of the
+        threshold a change pair falls on. Only valid with a single threshold.
+        :type prune: bool
+        :returns: The merged changes at each threshold, in the order of the thresholds.
+        :rtype: list[list[change.Change | change.CompoundChange]]
+        """
+
+        if prune and len(thresholds) != 1:
+            raise ValueError('Pruning requires a single threshold.')
+
+        commit = self.repo.commit(commit_hash)
+
+        # The preparation stages don't depend on each other. They read git
+        # through the reader of the repository, which is safe to share
+        # between threads.
+        stages = {
+            'changes': lambda: commit_splitter.collect_changes(self.repo, commit, self.repo_path),
+            'call_graph': lambda: call_graph.load_call_graph(self.call_graph_cache, self.reader, commit.hexsha),
+            'co_change_index': self.co_change_index
+        }
+
+        resources = run_stages({name: stage for name, stage in stages.items() if name == 'changes' or name in self.required})
+        resources['tree'] = commit.tree
+        changes = resources.pop('changes')
+
+        profiling.count('commits')
+        profiling.count('changes', len(changes))
+
+        # Only the files touched by the commit are indexed, as they are at the commit.
+        if 'method_lookup' in self.required:
+            with profiling.timer('stage.method_lookup'):
+                snapshots = [change.source_file_snapshot for change in changes]
+                resources['method_lookup'] = MethodLookup(index_snapshots(self.reader, snapshots, self.method_index_cache))
+
+        # 0 means changes are close, 1 means they are far
+        threshold = thresholds[0] if prune else None
+
+        with profiling.timer('stage.scoring'):
+            change_matrix = scoring.score_changes(resources, changes, self.voter_names, matrix_path, jobs, threshold)
+
+        # The merge history is computed once and cut at each threshold.
+        with profiling.timer('stage.linkage'):
+            history = merger.linkage(change_matrix)
+
+        with profiling.timer('stage.cut'):
+            return [merger.cut(history, changes, threshold) for threshold in thresholds]
+
+
+def main(repo_path, commit_hash, thresholds=(0.4,), matrix_path=None, since=None, max_count=None, cache_dir=DEFAULT_CACHE_DIR, jobs=1, prune=False, voter_names=voters.DEFAULT_VOTERS):
     """
     :param repo_path: The path to the repository to mine.
     :type repo_path: str
     :param commit_hash: The commit hash of the commit to untangle.
     :type commit_hash: str
+    :param thresholds: The thresholds to merge the changes at.
+    :type thresholds: list[float]
+    :param matrix_path: An optional file to memory-map the change matrix to.
+    :type matrix_path: str | None
+    :param since: Only mine the history more recent than this date.
+    :type since: str | None
+    :param max_count: Only mine this many of the most recent commits.
+    :type max_count: int | None
+    :param cache_dir: The directory to cache indexes in across runs.
+    :type cache_dir: str
+    :param jobs: The number of processes to score the change pairs with.
+    :type jobs: int
+    :param prune: Whether to skip the voters that can't change which side of the
+    threshold a change pair falls on. Only valid with a single threshold.
+    :type prune: bool
+    :param voter_names: The names of the confidence voters to score the change pairs with.
+    :type voter_names: list[str]
     """
 
-    repo = Repo(args.repo_path)
-    git = repo.git
+    untangler = Untangler(repo_path, since, max_count, cache_dir, voter_names)
 
-    commit = repo.commit(commit_hash)
+    try:
+        for threshold, merged_changes in zip(thresholds, untangler.untangle(commit_hash, thresholds, matrix_path, jobs, prune)):
+            if len(thresholds) > 1:
+                print(f'======= threshold {threshold} =======')
 
-    changes = commit_splitter.collect_changes(repo, commit, repo_path)
+            for change in merged_changes:
+                print(str(change))
+    finally:
+        untangler.close()
 
-    static_call_graph = call_graph.generate_call_graph(git, commit_hash, args.repo_path)
 
-    method_index = call_graph.generate_method_index(args.repo_path)
+def list_commits(repo_path, revision_range=None, commits_file=None):
+    """
+    :param repo_path: The path to the repository.
+    :type repo_path: str
+    :param revision_range: A revision range of git rev-list (e.g. v1.0..master).
+    :type revision_range: str | None
+    :param commits_file: A file with one commit hash per line, read instead of the range.
+    :type commits_file: str | None
+    :returns: The hashes of the commits, from the oldest for a range.
+    :rtype: list[str]
+    """
 
-    change_matrix = {}
+    if commits_file:
+        with open(commits_file) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
 
-    for change_1 in changes:
-        for change_2 in changes:
-            change_pair = (change_1, change_2)
+    # Oldest first, so that call graphs can often be updated from the parent's.
+    return git_reader.for_repo(Repo(repo_path)).run('rev-list', '--reverse', revision_range).split()
 
-            if change_1 == change_2:
-                score = None
-            else:
-                # 0 means changes are close, 1 means they are far
-                file_distance = confidence_voters.calculate_file_distance(*change_pair)
-                package_distance = confidence_voters.calculate_package_distance(commit.tree, *change_pair)
-                call_graph_distance = confidence_voters.calculate_call_graph_distance(static_call_graph, method_index, *change_pair)
-                co_change_frequency = confidence_voters.calculate_co_change_frequency(repo, *change_pair)
 
-                voters = [file_distance, package_distance, call_graph_distance, co_change_frequency]
-                voters = [v for v in voters if v >= 0 and v <= 1]
+def untangle_record(untangler, commit_hash, thresholds, prune=False):
+    """
+    Untangles a commit into a JSON line. A commit that fails is recorded
+    with its error rather than stopping the batch.
+    :param untangler: The untangler of the repository.
+    :type untangler: Untangler
+    :param commit_hash: The commit hash of the commit to untangle.
+    :type commit_hash: str
+    :param thresholds: The thresholds to merge the changes at.
+    :type thresholds: list[float]
+    :param prune: Whether to prune the voters, see Untangler.untangle.
+    :type prune: bool
+    :returns: The JSON object of the commit, on one line. The changes merged at
+    each threshold are lists of (operation, path, line number) objects.
+    :rtype: str
+    """
+
+    record = {'commit': commit_hash}
 
-                sum = 0
+    try:
+        merged_changes = untangler.untangle(commit_hash, thresholds, prune=prune)
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        return json.dumps(record)
 
-                for v in voters:
-                    sum += v
+    record['thresholds'] = {}
 
-                score = sum / len(voters)
+    for threshold, threshold_changes in zip(thresholds, merged_changes):
+        record['thresholds'][str(threshold)] = [
+            [
+                {'operation': c.operation, 'file': c.source_file_snapshot.relative_path, 'line_number': c.line_number}
+                for c in (group.changes if isinstance(group, CompoundChange) else [group])
+            ]
+            for group in threshold_changes
+        ]
 
-            if not change_matrix.get(change_pair[0]):
-                change_matrix[change_pair[0]] = {}
+    return json.dumps(record)
 
-            change_matrix[change_pair[0]][change_pair[1]] = score
 
-    final_matrix = merger.merge(change_matrix, 0.4)
+# The untangler of a batch worker process, see _init_worker.
+_worker_untangler = None
 
-    for change in final_matrix.keys():
-        print(str(change))
+
+def _init_worker(repo_path, since, max_count, cache_dir, voter_names):
+    """
+    Creates the untangler a batch worker process keeps for all its commits.
+    """
+
+    global _worker_untangler
+
+    _worker_untangler = Untangler(repo_path, since, max_count, cache_dir, voter_names)
+
+
+def _untangle_in_worker(commit_hash, thresholds, prune):
+    return untangle_record(_worker_untangler, commit_hash, thresholds, prune)
+
+
+def batch(repo_path, commit_hashes, thresholds=(0.4,), since=None, max_count=None, cache_dir=DEFAULT_CACHE_DIR, jobs=1, prune=False, voter_names=voters.DEFAULT_VOTERS, output=sys.stdout):
+    """
+    Untangles many commits of a repository, writing one JSON line per
+    commit, in order, as soon as it is untangled. See untangle_record.
+    :param repo_path: The path to the repository to mine.
+    :type repo_path: str
+    :param commit_hashes: The hashes of the commits to untangle.
+    :type commit_hashes: list[str]
+    :param thresholds: The thresholds to merge the changes at.
+    :type thresholds: list[float]
+    :param since: Only mine the history more recent than this date.
+    :type since: str | None
+    :param max_count: Only mine this many of the most recent commits.
+    :type max_count: int | None
+    :param cache_dir: The directory to cache indexes in across runs.
+    :type cache_dir: str
+    :param jobs: The number of processes to untangle the commits with. Each
+    process keeps its untangler, and scores the change pairs on its own.
+    :type jobs: int
+    :param prune: Whether to prune the voters, see Untangler.untangle.
+    :type prune: bool
+    :param voter_names: The names of the confidence voters to score the change pairs with.
+    :type voter_names: list[str]
+    :param output: Where to write the JSON lines.
+    :type output: io.TextIOBase
+    """
+
+    if prune and len(thresholds) != 1:
+        raise ValueError('Pruning requires a single threshold.')
+
+    untangler = Untangler(repo_path, since, max_count, cache_dir, voter_names)
+
+    try:
+        # The co-change index is brought up to date once, before the workers
+        # load it from the cache.
+        if 'co_change_index' in untangler.required:
+            untangler.co_change_index()
+
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(repo_path, since, max_count, cache_dir, voter_names)) as executor:
+                for record in executor.map(_untangle_in_worker, commit_hashes, repeat(thresholds), repeat(prune)):
+                    print(record, file=output, flush=True)
+        else:
+            for commit_hash in commit_hashes:
+                print(untangle_record(untangler, commit_hash, thresholds, prune), file=output, flush=True)
+    finally:
+        untangler.close()
 
  
 if __name__ == '__main__':
@@ -77,9 +363,101 @@ if __name__ == '__main__':
 
     parser.add_argument(
         'commit_hash',
-        help='The commit hash of the commit to untangle.'
+        nargs='?',
+        help='The commit hash of the commit to untangle. Omitted in batch mode.'
+    )
+
+    parser.add_argument(
+        '--range',
+        help='Untangle every commit of a revision range (e.g. v1.0..master) in batch mode, writing one JSON line per commit.'
+    )
+
+    parser.add_argument(
+        '--commits-file',
+        help='Untangle the commits listed in a file, one hash per line, in batch mode, writing one JSON line per commit.'
+    )
+
+    parser.add_argument(
+        '--thresholds',
+        type=float,
+        nargs='+',
+        default=[0.4],
+        help='The thresholds to merge the changes at. Defaults to 0.4.'
+    )
+
+    parser.add_argument(
+        '--matrix-file',
+        help='Memory-map the change matrix to this file, for very large commits.'
+    )
+
+    parser.add_argument(
+        '--since',
+        help='Only mine the history more recent than this date for co-changes.'
+    )
+
+    parser.add_argument(
+        '--max-count',
+        type=int,
+        help='Only mine this many of the most recent commits for co-changes.'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        default=DEFAULT_CACHE_DIR,
+        help=f'The directory to cache indexes in across runs. Defaults to {DEFAULT_CACHE_DIR}.'
+    )
+
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='The number of processes to score the change pairs with, or to untangle the commits with in batch mode. Defaults to 1.'
+    )
+
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='Skip the expensive voters of the change pairs the cheaper ones already decide. Requires a single threshold.'
+    )
+
+    parser.add_argument(
+        '--voters',
+        type=lambda names: names.split(','),
+        default=list(voters.DEFAULT_VOTERS),
+        help=f'The comma-separated confidence voters to score the change pairs with, among {",".join(voters.VOTERS)}. Defaults to all of them.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        help='Write the timers of the stages and voters, the git, cache and pair counters and the peak memory of the run to this file, as JSON. With --jobs, the work of the worker processes only shows in the totals of the child processes.'
     )
 
     args = parser.parse_args()
 
-    main(args.repo_path, args.commit_hash)
+    if args.prune and len(args.thresholds) != 1:
+        parser.error('--prune requires a single threshold.')
+
+    try:
+        voters.select(args.voters)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if sum(1 for source in (args.commit_hash, args.range, args.commits_file) if source) != 1:
+        parser.error('Give either a commit hash, --range or --commits-file.')
+
+    if args.matrix_file and not args.commit_hash:
+        parser.error('--matrix-file only applies to a single commit.')
+
+    if args.profile:
+        profiling.enable()
+
+    try:
+        if args.commit_hash:
+            main(args.repo_path, args.commit_hash, args.thresholds, args.matrix_file, args.since, args.max_count, args.cache_dir, args.jobs, args.prune, args.voters)
+        else:
+            commit_hashes = list_commits(args.repo_path, args.range, args.commits_file)
+            batch(args.repo_path, commit_hashes, args.thresholds, args.since, args.max_count, args.cache_dir, args.jobs, args.prune, args.voters)
+    finally:
+        # Slow and failed runs are the ones worth a report.
+        if args.profile:
+            profiling.write_report(args.profile)
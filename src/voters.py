@@ -0,0 +1,340 @@
+"""The registry of the confidence voters scoring change pairs."""
+
+import numpy as np
+import confidence_voters
+
+
+# The voters that can be selected for a run, by name, see register.
+VOTERS = {}
+
+# The voters run when none are selected.
+DEFAULT_VOTERS = ('file', 'package', 'cochange', 'callgraph')
+
+
+def register(voter_class):
+    """
+    Registers a voter under its name, so that runs can select it.
+    :param voter_class: The voter to register.
+    :type voter_class: type
+    :returns: The voter, so that this can decorate its class.
+    :rtype: type
+    """
+
+    VOTERS[voter_class.name] = voter_class
+
+    return voter_class
+
+
+def select(names):
+    """
+    Looks voters up by name.
+    :param names: The names of the voters to run.
+    :type names: list[str]
+    :returns: The voters, from the cheapest to the most expensive.
+    :rtype: list[type]
+    """
+
+    unknown = [name for name in names if name not in VOTERS]
+
+    if unknown:
+        raise ValueError(f'Unknown voters: {", ".join(unknown)}. Known voters are {", ".join(VOTERS)}.')
+
+    return sorted(set(VOTERS[name] for name in names), key=lambda voter_class: voter_class.cost)
+
+
+def requirements(names):
+    """
+    :param names: The names of the voters to run.
+    :type names: list[str]
+    :returns: The resources the voters need to be set up with.
+    :rtype: set[str]
+    """
+
+    return set(resource for voter_class in select(names) for resource in voter_class.requires)
+
+
+def _pairwise_table(keys, distance):
+    """
+    Builds a symmetric table of a distance function over every pair of keys.
+    :param keys: The keys to compare.
+    :type keys: list
+    :param distance: The function calculating the distance between two keys.
+    :type distance: (object, object) -> float
+    :rtype: numpy.ndarray
+    """
+
+    table = np.empty((len(keys), len(keys)))
+
+    for a in range(len(keys)):
+        for b in range(a, len(keys)):
+            table[a, b] = table[b, a] = distance(keys[a], keys[b])
+
+    return table
+
+
+def _index_methods(method_lookup, changes):
+    """
+    Assigns an integer id to each distinct method enclosing a change.
+    Each change is looked up once.
+    :param method_lookup: The lookup of the methods enclosing each line.
+    :type method_lookup: method_lookup.MethodLookup
+    :param changes: The changes to index.
+    :type changes: list[change.Change]
+    :returns: The method id of each change (-1 when the change isn't
+    in a method) and the method name of each method id.
+    :rtype: (numpy.ndarray, list[str])
+    """
+
+    method_ids = {}
+    methods = []
+    change_method_ids = np.empty(len(changes), dtype=np.intp)
+
+    for i, change in enumerate(changes):
+        method = method_lookup.find(change.source_file_snapshot.sha, change.line_number)
+
+        if not method:
+            change_method_ids[i] = -1
+            continue
+
+        if method not in method_ids:
+            method_ids[method] = len(methods)
+            methods.append(method)
+
+        change_method_ids[i] = method_ids[method]
+
+    return change_method_ids, methods
+
+
+def package_distance_table(tree, snapshots):
+    """
+    Calculates the package distance between every pair of touched files.
+    See confidence_voters.calculate_package_distance.
+    :param tree: The file tree.
+    :type tree: git.objects.tree.Tree
+    :param snapshots: One snapshot per file id.
+    :type snapshots: list[source_file.SourceFileSnapshot]
+    :rtype: numpy.ndarray
+    """
+
+    return _pairwise_table(snapshots, lambda a, b: confidence_voters.package_distance(tree, a, b))
+
+
+def call_graph_distance_table(static_call_graph, methods):
+    """
+    Calculates the call graph distance between every pair of touched methods.
+    See confidence_voters.calculate_call_graph_distance.
+
+    The table has an extra last row and column holding an invalid
+    vote (-1), used for changes that aren't in a method.
+
+    :param static_call_graph: The static call graph to traverse.
+    :type static_call_graph: call_graph.CallGraph
+    :param methods: The method name of each method id.
+    :type methods: list[str]
+    :rtype: numpy.ndarray
+    """
+
+    table = confidence_voters.call_graph_votes(static_call_graph.distance_table(methods))
+
+    return np.pad(table, ((0, 1), (0, 1)), mode='constant', constant_values=-1)
+
+
+def co_change_table(co_change_index, snapshots):
+    """
+    Calculates the co-change frequency vote between every pair of touched files.
+    See confidence_voters.calculate_co_change_frequency.
+    :param co_change_index: The index of the commits each file was changed in.
+    :type co_change_index: co_change_index.CoChangeIndex
+    :param snapshots: One snapshot per file id.
+    :type snapshots: list[source_file.SourceFileSnapshot]
+    :rtype: numpy.ndarray
+    """
+
+    file_paths = [s.relative_path for s in snapshots]
+
+    return _pairwise_table(file_paths, lambda a, b: confidence_voters.co_change_distance(co_change_index, a, b))
+
+
+class Voter(object):
+    """
+    A confidence voter, scoring change pairs between 0 (close) and 1
+    (far). Values outside of [0, 1] are invalid votes, left out of the
+    score of the pair.
+
+    Voters declare the resources of the run they are set up from (the
+    tree of the commit, the co-change index, the call graph and the
+    method lookup), so that runs only prepare the resources of the
+    selected voters. Voters with a lower cost are evaluated first.
+    """
+
+    # The name the voter is selected by.
+    name = None
+
+    # The relative cost of setting the voter up and evaluating it.
+    cost = 0
+
+    # The names of the resources the voter needs.
+    requires = ()
+
+    def __init__(self, resources, changes, file_ids, snapshots, lazy=False):
+        """
+        :param resources: The resources of the run, by name.
+        :type resources: dict[str, object]
+        :param changes: The changes to score.
+        :type changes: list[change.Change]
+        :param file_ids: The file id of each change.
+        :type file_ids: numpy.ndarray
+        :param snapshots: One snapshot per file id.
+        :type snapshots: list[source_file.SourceFileSnapshot]
+        :param lazy: Whether to only calculate what the pairs voted on need,
+        when few pairs are expected to be.
+        :type lazy: bool
+        """
+
+        self.file_ids = file_ids
+
+    def votes(self, i, j):
+        """
+        :param i: The ids of the first change of each pair.
+        :type i: numpy.ndarray | int
+        :param j: The ids of the second change of each pair.
+        :type j: numpy.ndarray
+        :returns: The vote on each pair.
+        :rtype: numpy.ndarray
+        """
+
+        raise NotImplementedError
+
+    def may_vote(self, i, j):
+        """
+        :param i: The ids of the first change of each pair.
+        :type i: numpy.ndarray
+        :param j: The ids of the second change of each pair.
+        :type j: numpy.ndarray
+        :returns: Whether the vote on each pair may be valid. This must only
+        be False for pairs the voter certainly has no valid vote for.
+        :rtype: numpy.ndarray
+        """
+
+        return np.ones(len(i), dtype=bool)
+
+
+@register
+class FileVoter(Voter):
+    """
+    The file distance, see confidence_voters.calculate_file_distance.
+    """
+
+    name = 'file'
+    cost = 0
+
+    def __init__(self, resources, changes, file_ids, snapshots, lazy=False):
+        super().__init__(resources, changes, file_ids, snapshots, lazy)
+
+        self.line_numbers = np.array([c.line_number for c in changes], dtype=np.float64)
+
+        # The deleted and added lines of a file are in snapshots of the parent
+        # and of the commit, of different lengths. Pairs of the file are divided
+        # by the longest, so that votes don't depend on the order of the changes.
+        self.file_lengths = np.zeros(len(snapshots))
+        np.maximum.at(self.file_lengths, file_ids, [c.source_file_snapshot.line_length for c in changes])
+
+    def votes(self, i, j):
+        file_distance = np.abs(self.line_numbers[j] - self.line_numbers[i]) / self.file_lengths[self.file_ids[i]]
+
+        return np.where(self.file_ids[j] == self.file_ids[i], file_distance, 1.0)
+
+
+@register
+class PackageVoter(Voter):
+    """
+    The package distance, see confidence_voters.calculate_package_distance.
+    """
+
+    name = 'package'
+    cost = 1
+    requires = ('tree',)
+
+    def __init__(self, resources, changes, file_ids, snapshots, lazy=False):
+        super().__init__(resources, changes, file_ids, snapshots, lazy)
+
+        self.table = package_distance_table(resources['tree'], snapshots)
+
+    def votes(self, i, j):
+        return self.table[self.file_ids[i], self.file_ids[j]]
+
+
+@register
+class CoChangeVoter(Voter):
+    """
+    The co-change frequency, see confidence_voters.calculate_co_change_frequency.
+    """
+
+    name = 'cochange'
+    cost = 2
+    requires = ('co_change_index',)
+
+    def __init__(self, resources, changes, file_ids, snapshots, lazy=False):
+        super().__init__(resources, changes, file_ids, snapshots, lazy)
+
+        if lazy:
+            # The table starts out unknown (NaN), see votes.
+            self.co_change_index = resources['co_change_index']
+            self.file_paths = [s.relative_path for s in snapshots]
+            self.table = np.full((len(snapshots), len(snapshots)), np.nan)
+        else:
+            self.table = co_change_table(resources['co_change_index'], snapshots)
+
+    def votes(self, i, j):
+        file_a = self.file_ids[i]
+        file_b = self.file_ids[j]
+
+        missing = np.isnan(self.table[file_a, file_b])
+
+        # Only the file pairs not needed before are calculated.
+        for a, b in set(zip(file_a[missing].tolist(), file_b[missing].tolist())):
+            self.table[a, b] = self.table[b, a] = confidence_voters.co_change_distance(self.co_change_index, self.file_paths[a], self.file_paths[b])
+
+        return self.table[file_a, file_b]
+
+
+@register
+class CallGraphVoter(Voter):
+    """
+    The call graph distance, see confidence_voters.calculate_call_graph_distance.
+    """
+
+    name = 'callgraph'
+    cost = 3
+    requires = ('call_graph', 'method_lookup')
+
+    def __init__(self, resources, changes, file_ids, snapshots, lazy=False):
+        super().__init__(resources, changes, file_ids, snapshots, lazy)
+
+        self.method_ids, methods = _index_methods(resources['method_lookup'], changes)
+
+        if lazy:
+            # The table starts out unknown (NaN), see votes.
+            self.static_call_graph = resources['call_graph']
+            self.methods = methods
+            self.table = np.full((len(methods) + 1, len(methods) + 1), np.nan)
+            self.table[-1, :] = self.table[:, -1] = -1
+        else:
+            self.table = call_graph_distance_table(resources['call_graph'], methods)
+
+    def votes(self, i, j):
+        method_a = self.method_ids[i]
+        method_b = self.method_ids[j]
+
+        missing = np.isnan(self.table[method_a, method_b])
+
+        # The call graph is searched once from all the methods of the pairs not needed before.
+        if np.any(missing):
+            method_ids = np.union1d(method_a[missing], method_b[missing])
+            shortest_paths = self.static_call_graph.distance_table([self.methods[m] for m in method_ids])
+            self.table[np.ix_(method_ids, method_ids)] = confidence_voters.call_graph_votes(shortest_paths)
+
+        return self.table[method_a, method_b]
+
+    def may_vote(self, i, j):
+        return (self.method_ids[i] >= 0) & (self.method_ids[j] >= 0)
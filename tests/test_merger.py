@@ -0,0 +1,134 @@
+"""Checks that merging by the merge history groups changes like connected components."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import merger
+from change import Change, CompoundChange
+from condensed_matrix import CondensedMatrix
+
+
+nan = np.nan
+
+# Recorded matrices, as the upper triangles of their rows.
+RECORDED_MATRICES = [
+    [],
+    [[0.2]],
+    [[0.9]],
+    [[nan]],
+    [[0.0, 0.9], [0.9]],
+    [[0.4, 0.1], [nan]],
+    [[0.3, nan, nan], [0.3, nan], [0.3]],
+    [[0.5, 0.1, nan, 0.0], [0.39, nan, 0.8], [nan, 0.2], [0.41]],
+    [[nan, nan, nan, nan], [nan, nan, nan], [nan, nan], [nan]],
+    [[0.1, 0.1, 0.1, 0.1], [0.1, 0.1, 0.1], [0.1, 0.1], [0.1]]
+]
+
+THRESHOLDS = [0.0, 0.1, 0.3, 0.4, 0.5, 1.0]
+
+
+def _matrix(rows):
+    size = len(rows) + 1 if rows else 1
+    change_matrix = CondensedMatrix(size)
+
+    for i, row in enumerate(rows):
+        for offset, value in enumerate(row):
+            change_matrix[i, i + 1 + offset] = value
+
+    return change_matrix
+
+
+def _random_matrix(random, size):
+    """
+    :returns: A matrix of values rounded to a tenth, so that many values tie
+    with each other and with the thresholds, with missing values and zeros.
+    :rtype: CondensedMatrix
+    """
+
+    change_matrix = CondensedMatrix(size)
+    values = np.round(random.random(len(change_matrix.values)), 1)
+    values[random.random(len(values)) < 0.3] = nan
+    values[random.random(len(values)) < 0.1] = 0.0
+    change_matrix.values[:] = values
+
+    return change_matrix
+
+
+def _connected_components(change_matrix, threshold):
+    """
+    The reference grouping: the connected components of the graph linking
+    every pair with a value below the threshold.
+    :rtype: set[frozenset[int]]
+    """
+
+    size = len(change_matrix)
+    groups = set()
+    seen = set()
+
+    for start in range(size):
+        if start in seen:
+            continue
+
+        component = {start}
+        stack = [start]
+
+        while stack:
+            i = stack.pop()
+
+            for j in range(size):
+                if j != i and j not in component and change_matrix[min(i, j), max(i, j)] < threshold:
+                    component.add(j)
+                    stack.append(j)
+
+        seen |= component
+        groups.add(frozenset(component))
+
+    return groups
+
+
+def _merged_groups(change_matrix, threshold):
+    """
+    :returns: The groups of change ids merged by merger.merge.
+    :rtype: set[frozenset[int]]
+    """
+
+    changes = [Change('add', '', i, None) for i in range(len(change_matrix))]
+    ids = {id(c): i for i, c in enumerate(changes)}
+
+    groups = set()
+
+    for merged in merger.merge(change_matrix, changes, threshold):
+        members = merged.changes if isinstance(merged, CompoundChange) else [merged]
+        groups.add(frozenset(ids[id(c)] for c in members))
+
+    assert sum(len(group) for group in groups) == len(changes)
+
+    return groups
+
+
+@pytest.mark.parametrize('rows', RECORDED_MATRICES)
+@pytest.mark.parametrize('threshold', THRESHOLDS)
+def test_recorded_matrices(rows, threshold):
+    change_matrix = _matrix(rows)
+
+    assert _merged_groups(change_matrix, threshold) == _connected_components(change_matrix, threshold)
+
+
+def test_recorded_grouping():
+    change_matrix = _matrix(RECORDED_MATRICES[7])
+
+    assert _merged_groups(change_matrix, 0.4) == {frozenset({0, 1, 2, 4}), frozenset({3})}
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_matrices(seed):
+    random = np.random.RandomState(seed)
+    change_matrix = _random_matrix(random, random.randint(2, 40))
+
+    for threshold in THRESHOLDS:
+        assert _merged_groups(change_matrix, threshold) == _connected_components(change_matrix, threshold)
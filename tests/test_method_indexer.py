@@ -0,0 +1,87 @@
+"""Checks the methods found in Java sources by the method indexer."""
+
+import os
+import subprocess
+import sys
+
+import git
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import commit_splitter
+import git_reader
+from method_indexer import index_snapshots, index_source
+from method_lookup import MethodLookup
+
+
+def test_record_declarations():
+    source = '\n'.join([
+        'package a.b;',
+        'public record Point<T>(T x, T y) {',
+        '    public T first() {',
+        '        return x;',
+        '    }',
+        '}',
+        'record Pair(int a, int b) implements Comparable<Pair> {',
+        '    public int compareTo(Pair other) {',
+        '        return a - other.a;',
+        '    }',
+        '}'
+    ])
+
+    assert index_source(source) == {'3-5': 'a.b.Point.first', '8-10': 'a.b.Pair.compareTo'}
+
+
+def test_record_identifiers():
+    source = '\n'.join([
+        'package a.b;',
+        'class Foo {',
+        '    void process(List<Record> records) {',
+        '        for (Record record : records) {',
+        '            executor.submit(new Runnable() {',
+        '                public void run() {',
+        '                    record.save();',
+        '                }',
+        '            });',
+        '        }',
+        '    }',
+        '}'
+    ])
+
+    assert index_source(source) == {'3-11': 'a.b.Foo.process', '6-8': 'a.b.Foo.(Anon_1).run'}
+
+
+def _commit(repo_path, files, message):
+    for file_path, source in files.items():
+        with open(os.path.join(repo_path, file_path), 'w') as f:
+            f.write(source)
+
+    subprocess.run(['git', 'add', '-A'], cwd=repo_path, check=True)
+    subprocess.run(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', message], cwd=repo_path, check=True)
+
+
+def test_modified_file_methods(tmp_path):
+    repo_path = str(tmp_path)
+    subprocess.run(['git', 'init', '-q', repo_path], check=True)
+
+    methods = {
+        'one': ['    void one() {', '        a();', '    }'],
+        'two': ['    void two() {', '        b();', '    }'],
+        'zero': ['    void zero() {', '        c();', '    }']
+    }
+
+    _commit(repo_path, {'Foo.java': '\n'.join(['package a;', 'class Foo {', *methods['one'], *methods['two'], '}', ''])}, 'Add Foo')
+
+    # zero is inserted above one, and a line of two is changed.
+    methods['two'][1] = '        d();'
+    _commit(repo_path, {'Foo.java': '\n'.join(['package a;', 'class Foo {', *methods['zero'], *methods['one'], *methods['two'], '}', ''])}, 'Change Foo')
+
+    repo = git.Repo(repo_path)
+    changes = commit_splitter.collect_changes(repo, repo.head.commit, repo_path)
+    lookup = MethodLookup(index_snapshots(git_reader.for_repo(repo), [c.source_file_snapshot for c in changes]))
+
+    found = {(c.operation, c.line.strip()): lookup.find(c.source_file_snapshot.sha, c.line_number) for c in changes}
+
+    assert found[('del', 'b();')] == 'a.Foo.two'
+    assert found[('add', 'd();')] == 'a.Foo.two'
+    assert found[('add', 'c();')] == 'a.Foo.zero'
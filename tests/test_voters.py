@@ -0,0 +1,37 @@
+"""Checks the votes of the confidence voters on changes of real commits."""
+
+import os
+import subprocess
+import sys
+
+import git
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import commit_splitter
+import scoring
+
+
+def test_file_votes_of_modified_file(tmp_path):
+    repo_path = str(tmp_path)
+    subprocess.run(['git', 'init', '-q', repo_path], check=True)
+
+    # The file grows from 3 to 40 lines, and its second line is changed.
+    for lines in (['a', 'b', 'c'], ['a', 'B', 'c'] + [f'x{k}' for k in range(37)]):
+        with open(os.path.join(repo_path, 'Foo.java'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        subprocess.run(['git', 'add', '-A'], cwd=repo_path, check=True)
+        subprocess.run(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'Change Foo'], cwd=repo_path, check=True)
+
+    repo = git.Repo(repo_path)
+    changes = commit_splitter.collect_changes(repo, repo.head.commit, repo_path)
+    deleted = next(c for c in changes if c.operation == 'del')
+    last = next(c for c in changes if c.line == 'x36')
+
+    assert deleted.source_file_snapshot.line_length != last.source_file_snapshot.line_length
+
+    # The vote is the same whichever change comes first, relative to the longer file.
+    for pair in ([deleted, last], [last, deleted]):
+        assert scoring.score_changes({}, pair, ['file'])[0, 1] == np.float32(38 / 40)